@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# بنچمارک موتور هشدار: بارگذاری، افزودن و بررسی اسنپ‌شات با یک میلیون هشدار فعال
+# اجرا از ریشه پروژه: python benchmarks/bench_alerts.py [تعداد هشدار]
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot
+from fake_servers import build_payload
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(3)
+    prices = bot.process_raw_prices(build_payload())
+    values = bot.alert_values(prices)
+    targets = list(values)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = bot.SettingsStore(os.path.join(tmp, "bot_data.db")).conn
+        bot.AlertEngine(conn)
+        rows = []
+        for i in range(count):
+            target = rng.choice(targets)
+            direction = rng.choice(('above', 'below'))
+            # آستانه‌ها تا ±۲۰٪ از مقدار فعلی فاصله دارند، پس هر حرکت کوچک فقط کسری از آن‌ها را فعال می‌کند
+            offset = abs(values[target]) * rng.uniform(0.001, 0.2)
+            threshold = values[target] + offset if direction == 'above' else values[target] - offset
+            rows.append((str(i % 200000), target, direction, threshold, 0.0))
+        conn.execute("BEGIN")
+        conn.executemany("INSERT INTO alerts (user_id, target, direction, threshold, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("COMMIT")
+
+        started = time.perf_counter()
+        engine = bot.AlertEngine(conn)
+        print(f"alerts={len(engine.alerts)} load={time.perf_counter() - started:.2f}s")
+
+        started = time.perf_counter()
+        for i in range(1000): engine.add(str(i), rng.choice(targets), 'above', 1e12 + i)
+        print(f"add:      {(time.perf_counter() - started) * 1000:8.3f} ms per 1000 alerts")
+
+        for move in (0.0, 0.002, 0.01, 0.05):
+            moved = {target: value * (1 + move) if rng.random() < 0.5 else value * (1 - move) for target, value in values.items()}
+            started = time.perf_counter()
+            triggered = engine.evaluate(moved)
+            elapsed = time.perf_counter() - started
+            # حذف‌ها در ربات در نخ جداگانه اجرا می‌شوند؛ اینجا فقط هزینه کل و بدترین دسته اندازه‌گیری می‌شود
+            started, worst_batch = time.perf_counter(), 0.0
+            while batch := engine.take_pending_deletes():
+                batch_started = time.perf_counter()
+                engine.delete_alerts(batch)
+                worst_batch = max(worst_batch, time.perf_counter() - batch_started)
+            print(f"evaluate move=±{move * 100:4.1f}%: {elapsed * 1000:8.3f} ms  triggered={len(triggered):7d}  "
+                  f"({elapsed * 1e6 / max(1, len(triggered)):.2f} us per hit)  remaining={len(engine.alerts)}  "
+                  f"db_delete={(time.perf_counter() - started) * 1000:.1f}ms (worst batch {worst_batch * 1000:.1f}ms)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# بنچمارک نمودارها: هزار درخواست‌کننده هم‌زمان با توزیع Zipf روی نمادها/بازه‌ها، رسم در استخر پردازه و کش تصویر و file_id
+# سقف نرخ ارسال تلگرام برای این اندازه‌گیری برداشته می‌شود تا ظرفیت خود مسیر نمودار دیده شود
+# اجرا از ریشه پروژه: python benchmarks/bench_charts.py [تعداد درخواست‌کننده] [تعداد پردازه رسم]
+
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot
+from fake_servers import FakeTelegram, build_payload
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+def write_history(directory, prices, now, days=90, step=600):
+    # تاریخچه مصنوعی (گام تصادفی) مستقیم در قالب فایل‌های ماهانه PriceHistory نوشته می‌شود
+    rng = np.random.default_rng(7)
+    timestamps = np.arange(now - days * 86400, now, step, dtype=float)
+    segments = np.array([bot.PriceHistory._segment_name(t) for t in timestamps[::144]]).repeat(144)[:len(timestamps)]
+    for symbol, item in prices.items():
+        if not bot.PriceHistory.SYMBOL_PATTERN.match(symbol): continue
+        steps = np.cumsum(rng.normal(0, 0.002, len(timestamps)))
+        walk = item['price'] * np.exp(steps - steps[-1])
+        os.makedirs(os.path.join(directory, symbol), exist_ok=True)
+        for segment in np.unique(segments):
+            mask = segments == segment
+            np.column_stack([timestamps[mask], walk[mask]]).astype('<f8').tofile(os.path.join(directory, symbol, segment))
+
+def chart_specs(symbols):
+    # درخواست‌های پرتکرار اول فهرست‌اند؛ وزن هر درخواست 1/رتبه
+    popular = [s for s in ('USD', 'EUR', 'IR_GOLD_18K', 'IR_COIN_EMAMI', 'BTC', 'USDT_IRT', 'AED', 'GBP') if s in symbols]
+    specs = [(('BUBBLE',), '30d')]
+    for range_label in ('7d', '1d', '30d', '90d', '1y'):
+        specs += [((symbol,), range_label) for symbol in popular]
+    specs += [(tuple(sorted(pair)), '7d') for pair in zip(popular, popular[1:])]
+    specs += [((symbol,), '7d') for symbol in sorted(symbols) if symbol not in popular]
+    return specs, [1.0 / (rank + 1) for rank in range(len(specs))]
+
+async def wave(telegram, fake_telegram, requests, label):
+    counters = {key: bot.CACHE_REQUESTS.values.get(key, 0) for key in bot.CACHE_REQUESTS.values}
+    photos_before, started = len(fake_telegram.photos), time.perf_counter()
+    results = await asyncio.gather(*(bot.send_chart(telegram, chat_id, *spec) for chat_id, spec in requests), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    delta = lambda *key: bot.CACHE_REQUESTS.values.get(key, 0) - counters.get(key, 0)
+    hits, shared, misses = delta('chart', 'hit'), delta('chart', 'shared'), delta('chart', 'miss')
+    photos = fake_telegram.photos[photos_before:]
+    uploads = sum(1 for _, _, uploaded in photos if uploaded)
+    errors = [r for r in results if isinstance(r, Exception)]
+    print(f"{label:<22} charts/s={len(requests) / elapsed:7.1f}  elapsed={elapsed:5.2f}s  renders={misses:3d}  "
+          f"hit rate={(hits + shared) * 100 / len(requests):5.1f}% (cached {hits}, shared in-flight {shared})  "
+          f"uploads={uploads:3d}  file_id sends={len(photos) - uploads:4d}"
+          + (f"  errors={len(errors)} ({errors[0]!r})" if errors else ""))
+
+async def main():
+    requesters = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bot.CHART_WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else bot.CHART_WORKERS
+    workdir = tempfile.mkdtemp(prefix="bench_charts_")
+    bot.SETTINGS_DB_FILE, bot.HISTORY_DIR = os.path.join(workdir, "bot_data.db"), os.path.join(workdir, "price_history")
+    now = time.time()
+    prices = bot.process_raw_prices(build_payload())
+    write_history(bot.HISTORY_DIR, prices, now)
+    bot.telegram_rate_limiter = bot.RateLimiter(100000, 0)
+
+    fake_telegram = FakeTelegram(latency=0.03)
+    telegram = Bot("123:BENCH", base_url=await fake_telegram.start(), request=HTTPXRequest(connection_pool_size=256, pool_timeout=30))
+    await telegram.initialize()
+    pool_started = time.perf_counter()
+    await asyncio.gather(*(asyncio.get_running_loop().run_in_executor(bot.get_chart_pool(), time.sleep, 0.2) for _ in range(bot.CHART_WORKERS)))
+    print(f"chart pool: {bot.CHART_WORKERS} workers ready in {time.perf_counter() - pool_started:.1f}s; cache size {bot.CHART_CACHE_MAX_ENTRIES}")
+
+    specs, weights = chart_specs(set(prices))
+    rng = random.Random(11)
+    def sample(): return [(300000 + i, spec) for i, spec in enumerate(rng.choices(specs, weights, k=requesters))]
+    print(f"requesters={requesters}  distinct charts={len(specs)} (Zipf weights)")
+    await wave(telegram, fake_telegram, sample(), "cold cache")
+    await wave(telegram, fake_telegram, sample(), "warm cache")
+    # یک اسنپ‌شات تازه فقط نمودارهایی را باطل می‌کند که وضوحشان از فاصله دو نقطه ریزتر است (عملاً بازه ۱ روزه)
+    history = bot.get_price_history()
+    history.append(history.last_timestamp('USD') + 90, {symbol: item['price'] for symbol, item in prices.items()})
+    await wave(telegram, fake_telegram, sample(), "next snapshot (+90s)")
+    history.append(history.last_timestamp('USD') + 86400, {symbol: item['price'] for symbol, item in prices.items()})
+    await wave(telegram, fake_telegram, sample(), "next day (+1d)")
+    await wave(telegram, fake_telegram, sample(), "warm again")
+
+    # سقف بدون کش: هر درخواست یک رسم کامل؛ زمان رسم یک نمودار در همین پردازه اندازه‌گیری می‌شود
+    bot._init_chart_worker(bot.HISTORY_DIR)
+    bot.render_price_chart(('USD',), now - 7 * 86400, now, '7d')
+    started = time.perf_counter()
+    for _ in range(5): bot.render_price_chart(('USD',), now - 7 * 86400, now, '7d')
+    render_time = (time.perf_counter() - started) / 5
+    print(f"single render={render_time * 1000:.0f}ms -> uncached ceiling ≈{bot.CHART_WORKERS / render_time:.0f} charts/s with {bot.CHART_WORKERS} workers (on {os.cpu_count()} CPU)")
+    bot.shutdown_chart_pool()
+    await telegram.shutdown()
+    await fake_telegram.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
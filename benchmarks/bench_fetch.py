@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# بنچمارک مسیر دریافت قیمت در برابر FakeBrsApi: تأخیر حلقه رویداد، مهلت هر تلاش و قطع‌کننده مدار
+# پیش از اندازه‌گیری، رفتار قطع‌کننده مدار، تلاش مجدد و مهلت هر تلاش با assert بررسی می‌شود
+# اجرا از ریشه پروژه: python benchmarks/bench_fetch.py
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot
+from fake_servers import FakeBrsApi
+
+async def measure_loop_lag(stop_event, interval=0.01):
+    worst = 0.0
+    while not stop_event.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+async def check_fetch_behaviour():
+    # هر بررسی یک PriceProvider تازه در برابر FakeBrsApi می‌سازد؛ بدون hedge تا شمار درخواست‌های بالادست دقیق باشد
+    saved = (bot.CIRCUIT_RESET_TIMEOUT, bot.FETCH_ATTEMPT_TIMEOUT, bot.FETCH_MAX_ATTEMPTS, bot.HEDGE_MAX_EXTRA, bot.FETCH_BACKOFF_BASE)
+    bot.CIRCUIT_RESET_TIMEOUT, bot.FETCH_ATTEMPT_TIMEOUT, bot.HEDGE_MAX_EXTRA, bot.FETCH_BACKOFF_BASE = 0.5, 0.3, 0, 0.01
+    async def provider_for(fake, attempts=1):
+        bot.FETCH_MAX_ATTEMPTS = attempts
+        return bot.PriceProvider("check", await fake.start())
+    try:
+        # پس از CIRCUIT_FAILURE_THRESHOLD شکست باز می‌شود و تا پایان مهلت بدون تماس با بالادست رد می‌کند
+        fake = FakeBrsApi(error_rate=1.0)
+        provider = await provider_for(fake)
+        for _ in range(bot.CIRCUIT_FAILURE_THRESHOLD):
+            assert provider.breaker.state == "closed"
+            assert await provider.fetch(bot.get_http_client()) is None
+        assert provider.breaker.state == "open", provider.breaker.state
+        requests = fake.requests
+        for _ in range(5): assert await provider.fetch(bot.get_http_client()) is None
+        assert fake.requests == requests, "open breaker must not reach upstream"
+        # پس از CIRCUIT_RESET_TIMEOUT دقیقاً یک تلاش آزمایشی هم‌زمان مجاز است؛ شکست آن مدار را دوباره باز می‌کند
+        await asyncio.sleep(bot.CIRCUIT_RESET_TIMEOUT)
+        assert provider.breaker.state == "half_open"
+        await asyncio.gather(*(provider.fetch(bot.get_http_client()) for _ in range(5)))
+        assert fake.requests == requests + 1, f"half-open allowed {fake.requests - requests} trials"
+        assert provider.breaker.state == "open"
+        # تلاش آزمایشی موفق مدار را می‌بندد
+        await asyncio.sleep(bot.CIRCUIT_RESET_TIMEOUT)
+        fake.error_rate = 0.0
+        assert await provider.fetch(bot.get_http_client())
+        assert provider.breaker.state == "closed" and provider.breaker.failures == 0
+        await fake.stop()
+
+        # خطای 4xx تکرار نمی‌شود ولی 5xx تا FETCH_MAX_ATTEMPTS بار تکرار می‌شود
+        fake = FakeBrsApi(error_rate=1.0, error_status=404)
+        provider = await provider_for(fake, attempts=3)
+        assert await provider.fetch(bot.get_http_client()) is None
+        assert fake.requests == 1, f"4xx retried {fake.requests - 1} times"
+        fake.error_status = 503
+        assert await provider.fetch(bot.get_http_client()) is None
+        assert fake.requests == 1 + 3, f"5xx sent {fake.requests - 1} requests"
+        await fake.stop()
+
+        # پاسخی که هرگز نمی‌رسد در FETCH_ATTEMPT_TIMEOUT قطع می‌شود
+        fake = FakeBrsApi(slow_rate=1.0, slow_latency=10.0)
+        provider = await provider_for(fake)
+        started = time.perf_counter()
+        assert await provider.fetch(bot.get_http_client()) is None
+        elapsed = time.perf_counter() - started
+        assert bot.FETCH_ATTEMPT_TIMEOUT <= elapsed < bot.FETCH_ATTEMPT_TIMEOUT + 0.5, f"hung attempt took {elapsed:.2f}s"
+        await fake.stop()
+    finally:
+        bot.CIRCUIT_RESET_TIMEOUT, bot.FETCH_ATTEMPT_TIMEOUT, bot.FETCH_MAX_ATTEMPTS, bot.HEDGE_MAX_EXTRA, bot.FETCH_BACKOFF_BASE = saved
+        await bot.close_http_client()
+    print("fetch checks passed: breaker open/reject/single trial, no 4xx retry, hung attempt cut at timeout")
+
+async def run_scenario(name, fake, calls, concurrency):
+    bot.BRSAPI_URL = await fake.start()
+    bot._price_providers = None
+    stop_event = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop_event))
+    semaphore, ok, latencies = asyncio.Semaphore(concurrency), 0, []
+    async def one_call():
+        nonlocal ok
+        async with semaphore:
+            started = time.perf_counter()
+            if await bot.get_and_process_prices(): ok += 1
+            latencies.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    await asyncio.gather(*(one_call() for _ in range(calls)))
+    elapsed = time.perf_counter() - started
+    stop_event.set()
+    worst_lag = await lag_task
+    await bot.close_http_client()
+    await fake.stop()
+    latencies.sort()
+    print(f"{name:<28} ok={ok}/{calls} upstream_requests={fake.requests:<4} elapsed={elapsed:6.2f}s "
+          f"p50={latencies[len(latencies) // 2] * 1000:7.1f}ms max={latencies[-1] * 1000:7.1f}ms "
+          f"breaker={bot.get_price_providers()[0].breaker.state:<9} worst_loop_lag={worst_lag * 1000:.1f}ms")
+
+async def main():
+    await check_fetch_behaviour()
+    bot.FETCH_ATTEMPT_TIMEOUT = 1.0
+    await run_scenario("healthy (50ms)", FakeBrsApi(latency=0.05), calls=200, concurrency=50)
+    await run_scenario("30% errors", FakeBrsApi(latency=0.02, error_rate=0.3), calls=100, concurrency=20)
+    await run_scenario("10% hangs (10s)", FakeBrsApi(latency=0.02, slow_rate=0.1), calls=100, concurrency=20)
+    await run_scenario("down (100% errors)", FakeBrsApi(error_rate=1.0), calls=100, concurrency=10)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# بنچمارک دریافت چندمنبعی با درخواست پشتیبان (hedge): صدک‌های تأخیر get_and_process_prices در برابر منابع جایگزین
+# با پاسخ‌های کند و خطای تزریقی. یکی از منابع در سناریوی سوم انحراف ثابت دارد تا علامت‌گذاری داده پرت دیده شود.
+# اجرا از ریشه پروژه: python benchmarks/bench_providers.py [تعداد فراخوانی]
+
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot
+from fake_servers import FakeBrsApi
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+async def run_scenario(name, fakes, calls, hedge=True, concurrency=4):
+    urls = [await fake.start() for fake in fakes]
+    bot._price_providers = [bot.PriceProvider(f"p{i}", url, {'key': 'bench'}) for i, url in enumerate(urls)]
+    if not hedge:
+        for provider in bot._price_providers: provider.hedge_delay = lambda: None
+    bot.HEDGED_REQUESTS.values.clear()
+    bot.PRICE_OUTLIERS.values.clear()
+    semaphore, latencies, failures, mesghal = asyncio.Semaphore(concurrency), [], 0, 0
+    async def one_call(record):
+        nonlocal failures, mesghal
+        async with semaphore:
+            started = time.perf_counter()
+            prices = await bot.get_and_process_prices()
+            if not record: return
+            latencies.append(time.perf_counter() - started)
+            if not prices: failures += 1
+            elif 'IR_GOLD_MESGHAL' in prices: mesghal += 1
+    # گرم‌کردن: پنجره تأخیر هر منبع پیش از اندازه‌گیری پر می‌شود
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(one_call(False) for _ in range(bot.HEDGE_MIN_SAMPLES * 2)))
+        await asyncio.gather(*(one_call(True) for _ in range(calls)))
+        await asyncio.gather(*bot._background_fetches)
+    await bot.close_http_client()
+    for fake in fakes: await fake.stop()
+    latencies.sort()
+    hedges = sum(count for (_, result), count in bot.HEDGED_REQUESTS.values.items() if result == 'sent')
+    outliers = sum(bot.PRICE_OUTLIERS.values.values())
+    print(f"{name:<34} p50={percentile(latencies, 0.5):7.1f}ms p95={percentile(latencies, 0.95):7.1f}ms "
+          f"p99={percentile(latencies, 0.99):7.1f}ms max={latencies[-1] * 1000:7.1f}ms failed={failures}/{calls} "
+          f"mesghal={mesghal}/{calls - failures} hedges={hedges} outliers={outliers} upstream={sum(fake.requests for fake in fakes)}")
+
+def flaky(bias=0.0):
+    # ۵٪ پاسخ‌ها ۳ ثانیه طول می‌کشند و ۵٪ خطای 503 می‌دهند
+    return FakeBrsApi(latency=0.04, slow_rate=0.05, slow_latency=3.0, error_rate=0.05, jitter=0.001, bias=bias)
+
+async def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    bot.FETCH_ATTEMPT_TIMEOUT = 2.0
+    await run_scenario("1 provider, no hedge", [flaky()], calls, hedge=False)
+    await run_scenario("1 provider, hedged", [flaky()], calls)
+    await run_scenario("3 providers, hedged + median", [flaky(), flaky(), flaky(bias=0.05)], calls)
+
+if __name__ == "__main__":
+    asyncio.run(main())
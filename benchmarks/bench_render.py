@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# بنچمارک هزینه ساخت گزارش خودکار برای هر کاربر، بدون کش قطعات و با کش قطعات
+# اجرا از ریشه پروژه: python benchmarks/bench_render.py [تعداد کاربران]
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot
+from fake_servers import build_payload
+
+bot.HISTORY_DIR = tempfile.mkdtemp(prefix="bench_history_")
+
+def synthetic_population(count, seed=7):
+    # بیشتر کاربران تنظیمات پیش‌فرض را نگه می‌دارند؛ بقیه زیرمجموعه‌ای تصادفی انتخاب کرده‌اند
+    rng, users = random.Random(seed), []
+    defaults = {"currency": ['USD', 'EUR', 'AED', 'USDT_IRT'], "gold": ['IR_COIN_EMAMI', 'IR_GOLD_18K'], "crypto": ['BTC', 'ETH']}
+    for _ in range(count):
+        if rng.random() < 0.6: prefs = {cat: list(symbols) for cat, symbols in defaults.items()}
+        else: prefs = {cat: rng.sample(list(bot.FULL_SYMBOL_LIST[cat]), rng.randint(1, 4)) for cat in bot.FULL_SYMBOL_LIST}
+        reports = rng.choice([["gold", "bubble"], ["currency", "gold", "bubble"], ["currency"], ["crypto", "bubble"]])
+        users.append((prefs, reports))
+    return users
+
+def render_uncached(snapshot, prefs, reports):
+    report = f"🔔 <b>گزارش خودکار شما - {bot._build_persian_date_header()}</b>\n====================\n"
+    for report_type in reports:
+        if report_type == 'bubble': report += bot.build_bubble_report(snapshot['prices']) + "\n\n"
+        else: report += bot.build_single_report(report_type, prefs, snapshot['prices'], bot.get_reference_prices(snapshot)) + "\n"
+    return report
+
+def render_cached(snapshot, prefs, reports):
+    report = f"🔔 <b>گزارش خودکار شما - {bot.get_persian_date_header()}</b>\n====================\n"
+    for report_type in reports:
+        report += bot.render_report(report_type, prefs, snapshot) + ("\n\n" if report_type == 'bubble' else "\n")
+    return report
+
+def measure(render, snapshot, users):
+    started = time.perf_counter()
+    for prefs, reports in users: render(snapshot, prefs, reports)
+    return time.perf_counter() - started
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    users = synthetic_population(count)
+    snapshot = {'version': 1, 'fetched_at': time.time(), 'prices': bot.process_raw_prices(build_payload())}
+    assert all(render_uncached(snapshot, p, r) == render_cached(snapshot, p, r) for p, r in users[:200])
+    snapshot = dict(snapshot, version=2)
+    uncached = measure(render_uncached, snapshot, users)
+    cached = measure(render_cached, snapshot, users)
+    distinct = len(bot._report_cache)
+    print(f"users={count} distinct_fragments={distinct}")
+    print(f"uncached: {uncached * 1e6 / count:8.1f} us/user  total={uncached:.3f}s")
+    print(f"cached:   {cached * 1e6 / count:8.1f} us/user  total={cached:.3f}s  speedup={uncached / cached:.1f}x")
+
+if __name__ == "__main__":
+    main()
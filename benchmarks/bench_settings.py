@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# بنچمارک توان عملیاتی تغییر تنظیمات: بازنویسی کامل فایل JSON در برابر SettingsStore (SQLite/WAL)
+# اجرا از ریشه پروژه: python benchmarks/bench_settings.py [تعداد کاربران]
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot
+
+def json_toggle(path, user_id, symbol):
+    # مسیر قدیمی: بارگذاری کل فایل، تغییر یک کاربر و بازنویسی کل فایل با indent=4
+    with open(path, 'r', encoding='utf-8') as f: all_settings = json.load(f)
+    bot._toggle_member(all_settings[user_id]['currency'], symbol)
+    with open(path, 'w', encoding='utf-8') as f: json.dump(all_settings, f, indent=4, ensure_ascii=False)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(1)
+    symbols = list(bot.FULL_SYMBOL_LIST['currency'])
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path, db_path = os.path.join(tmp, "user_settings.json"), os.path.join(tmp, "bot_data.db")
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({str(i): bot.default_user_prefs() for i in range(count)}, f, indent=4, ensure_ascii=False)
+        print(f"users={count} json_size={os.path.getsize(json_path) / 1e6:.1f}MB")
+
+        ops = 5
+        started = time.perf_counter()
+        for _ in range(ops): json_toggle(json_path, str(rng.randrange(count)), rng.choice(symbols))
+        json_elapsed = time.perf_counter() - started
+        print(f"json rewrite:   {ops / json_elapsed:10.1f} toggles/s  ({json_elapsed / ops * 1000:.1f} ms/toggle)")
+
+        started = time.perf_counter()
+        store = bot.SettingsStore(db_path)
+        store.migrate_from_json(json_path)
+        print(f"migration:      {time.perf_counter() - started:10.2f} s")
+
+        ops = 20000
+        started = time.perf_counter()
+        for _ in range(ops):
+            symbol = rng.choice(symbols)
+            store.update(rng.randrange(count), lambda prefs: bot._toggle_member(prefs['currency'], symbol), bot.default_user_prefs)
+        store_elapsed = time.perf_counter() - started
+        print(f"sqlite store:   {ops / store_elapsed:10.1f} toggles/s  ({store_elapsed / ops * 1000:.3f} ms/toggle)")
+
+        started = time.perf_counter()
+        for _ in range(ops): store.get(rng.randrange(count))
+        print(f"cached reads:   {ops / (time.perf_counter() - started):10.1f} reads/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# بنچمارک تیکر زنده: هزاران پیام زنده، چند اسنپ‌شات پشت سر هم و شمارش ویرایش‌های واقعی در برابر ویرایش ساده‌لوحانه
+# اجرا از ریشه پروژه: python benchmarks/bench_ticker.py [تعداد تیکر] [نرخ ویرایش در ثانیه]
+
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot
+from fake_servers import FakeTelegram, build_payload
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+def peak_rate(timestamps, window=1.0):
+    timestamps, peak, start = sorted(timestamps), 0, 0
+    for end, stamp in enumerate(timestamps):
+        while stamp - timestamps[start] > window: start += 1
+        peak = max(peak, end - start + 1)
+    return peak / window
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    edit_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 400.0
+    snapshots, interval = 8, 0.5
+    workdir = tempfile.mkdtemp(prefix="bench_ticker_")
+    bot.SETTINGS_DB_FILE, bot.HISTORY_DIR = os.path.join(workdir, "bot_data.db"), os.path.join(workdir, "price_history")
+    bot.telegram_rate_limiter = bot.RateLimiter(edit_rate * 2, 1.0)
+    bot._ticker_edit_bucket = bot.TokenBucket(edit_rate)
+    bot.TICKER_MIN_EDIT_INTERVAL = 1.0
+    fake_telegram = FakeTelegram(latency=0.002)
+    telegram = Bot("123:BENCH", base_url=await fake_telegram.start(), request=HTTPXRequest(connection_pool_size=256, pool_timeout=30))
+    await telegram.initialize()
+
+    rng = random.Random(5)
+    for i in range(count):
+        chat_id = str(200000 + i)
+        def choose(prefs): prefs['currency'] = rng.sample(list(bot.FULL_SYMBOL_LIST['currency']), rng.randint(1, 4))
+        await bot.update_user_prefs(chat_id, choose)
+        bot._tickers[chat_id] = bot.TickerState(chat_id, 1, 'currency')
+
+    # هر اسنپ‌شات فقط قیمت چند نماد را تغییر می‌دهد؛ بقیه ثابت می‌مانند
+    base = build_payload()
+    publish_costs, started = [], time.perf_counter()
+    for version in range(1, snapshots + 1):
+        for item in rng.sample(base['currency'], 3): item['price'] *= 1 + rng.uniform(-0.01, 0.01)
+        snapshot = {'version': version, 'fetched_at': time.time(), 'prices': bot.process_raw_prices(base)}
+        publish_started = time.perf_counter()
+        queued = bot.publish_ticker_snapshot(telegram, snapshot)
+        publish_costs.append(time.perf_counter() - publish_started)
+        print(f"snapshot {version}: queued={queued:5d}  publish={publish_costs[-1] * 1000:6.1f}ms")
+        await asyncio.sleep(interval)
+    while any(state.flushing for state in bot._tickers.values()): await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    edits = [stamp for stamp, _ in fake_telegram.edited]
+    per_chat = {}
+    for stamp, chat_id in fake_telegram.edited: per_chat.setdefault(chat_id, []).append(stamp)
+    min_gap = min((b - a for stamps in per_chat.values() for a, b in zip(stamps, stamps[1:])), default=None)
+    print(f"tickers={count} snapshots={snapshots} naive_edits={count * snapshots} actual_edits={len(edits)} "
+          f"({len(edits) * 100 / (count * snapshots):.1f}%) elapsed={elapsed:.1f}s")
+    print(f"peak edit rate={peak_rate(edits):.0f}/s (limit {edit_rate:.0f}/s)  "
+          f"min gap per chat={min_gap if min_gap is None else f'{min_gap:.2f}s'} (limit {bot.TICKER_MIN_EDIT_INTERVAL:.1f}s)")
+    await telegram.shutdown()
+    await fake_telegram.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# بنچمارک حالت وب‌هوک چندپردازه: bot.py واقعی با ۱ تا N کارگر پشت مسیریاب محلی اجرا می‌شود و به‌روزرسانی‌ها با حداکثر نرخ ارسال می‌شوند.
+# توان عملیاتی = تعداد پاسخ‌های رسیده به Bot API جایگزین در ثانیه. تأخیر تلگرام شبیه‌سازی‌شده نشان می‌دهد هر کارگر
+# به‌روزرسانی‌ها را به ترتیب پردازش می‌کند؛ با --telegram-latency 0 محدودیت فقط CPU است و مقیاس‌پذیری به تعداد هسته‌ها بستگی دارد.
+# اجرا از ریشه پروژه: python benchmarks/bench_workers.py --workers 1 2 4 --updates 2000
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_servers import FakeBrsApi, FakeTelegram
+
+MENU_BUTTONS = ["💵 نرخ ارزها", "🪙 نرخ طلا و سکه", "📈 ارزهای دیجیتال", "🫧 تحلیل حباب"]
+SECRET = "bench-secret"
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def message_update(update_id, chat_id, text):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                                                'from': {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"}, 'text': text}}
+
+async def wait_until(predicate, timeout, what):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline: raise TimeoutError(f"timed out waiting for {what}")
+        await asyncio.sleep(0.05)
+
+async def run_cluster(workers, args, fake_telegram, brsapi_url):
+    workdir = tempfile.mkdtemp(prefix="bench_workers_")
+    port, base_port = free_port(), free_port()
+    while base_port + workers > 65535 or port in range(base_port, base_port + workers): base_port = free_port()
+    env = dict(os.environ, TELEGRAM_TOKEN="123:BENCH", BRSAPI_KEY="bench", BRSAPI_URL=brsapi_url,
+               TELEGRAM_API_BASE_URL=fake_telegram.base_url, WEBHOOK_URL=f"http://127.0.0.1:{port}/telegram",
+               WEBHOOK_PORT=str(port), WEBHOOK_WORKERS=str(workers), WEBHOOK_WORKER_BASE_PORT=str(base_port), WEBHOOK_SECRET=SECRET,
+               SETTINGS_DB_FILE=os.path.join(workdir, "bot_data.db"), HISTORY_DIR=os.path.join(workdir, "price_history"), METRICS_PORT="0")
+    # bot.py از پوشه موقت اجرا می‌شود تا user_settings.json و hourly_prices.json مخزن دست نخورند
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.abspath(ROOT), "bot.py")], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL if not args.verbose else None, stderr=subprocess.DEVNULL if not args.verbose else None)
+    try:
+        webhooks_before = fake_telegram.calls.get('setWebhook', 0)
+        await wait_until(lambda: fake_telegram.calls.get('setWebhook', 0) - webhooks_before >= workers, 60, "workers to start")
+        await asyncio.sleep(1.0)
+        sent_before = len(fake_telegram.sent)
+        url = f"http://127.0.0.1:{port}/telegram"
+        pending = iter(range(args.updates))
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.connections)) as client:
+            async def sender():
+                for i in pending:
+                    update = message_update(10 ** 6 + i, 100000 + i % args.users, MENU_BUTTONS[i % len(MENU_BUTTONS)])
+                    response = await client.post(url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': SECRET})
+                    response.raise_for_status()
+            started = time.perf_counter()
+            await asyncio.gather(*(sender() for _ in range(args.connections)))
+            accepted = time.perf_counter() - started
+        await wait_until(lambda: len(fake_telegram.sent) - sent_before >= args.updates, 600, "replies")
+        elapsed = time.perf_counter() - started
+        return accepted, elapsed
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(60)
+
+async def main(args):
+    fake_telegram, fake_brsapi = FakeTelegram(latency=args.telegram_latency), FakeBrsApi(latency=0.05)
+    await fake_telegram.start()
+    brsapi_url = await fake_brsapi.start()
+    baseline = None
+    print(f"updates={args.updates} users={args.users} telegram_latency={args.telegram_latency * 1000:.0f}ms cpus={os.cpu_count()}")
+    for workers in args.workers:
+        accepted, elapsed = await run_cluster(workers, args, fake_telegram, brsapi_url)
+        throughput = args.updates / elapsed
+        baseline = baseline or throughput
+        print(f"workers={workers:2d}  replies/s={throughput:8.1f}  speedup={throughput / baseline:5.2f}x  "
+              f"(webhook accepted in {accepted:.2f}s, all replies after {elapsed:.2f}s)")
+    print(f"BrsApi requests across all runs: {fake_brsapi.requests}")
+    await fake_telegram.stop()
+    await fake_brsapi.stop()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Throughput of webhook mode with 1..N worker processes.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--connections", type=int, default=40, help="concurrent webhook connections (Telegram uses up to 40)")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own output")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="simulated Bot API round trip (s)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
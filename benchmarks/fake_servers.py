@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# سرورهای جایگزین محلی برای بنچمارک‌ها: پاسخ‌ها را با تأخیر و خطای قابل تنظیم برمی‌گردانند
+
+import asyncio
+import json
+import random
+import re
+import time
+from urllib.parse import urlsplit, parse_qs, parse_qsl
+
+SAMPLE_SYMBOLS = {
+    'gold': {'IR_GOLD_18K': 13743700, 'IR_GOLD_24K': 18324900, 'IR_GOLD_MELTED': 59542000, 'IR_COIN_1G': 18900000,
+             'IR_COIN_QUARTER': 39500000, 'IR_COIN_HALF': 71000000, 'IR_COIN_EMAMI': 139500000,
+             'IR_COIN_BAHAR': 131000000, 'XAUUSD': 4331.5},
+    'currency': {'USD': 1302000, 'EUR': 1528000, 'AED': 354500, 'GBP': 1740000, 'TRY': 30500, 'USDT_IRT': 1299000,
+                 'JPY': 8350, 'CHF': 1638000, 'AUD': 862000, 'CAD': 944000, 'CNY': 184000},
+    'cryptocurrency': {'BTC': 87250.12, 'ETH': 2950.4, 'BNB': 842.3, 'SOL': 124.8, 'XRP': 1.87, 'DOGE': 0.128,
+                       'ADA': 0.37, 'SHIB': 0.0000072},
+}
+
+def build_payload(jitter=0.0, bias=0.0):
+    # خروجی هم‌شکل Gold_Currency.php؛ jitter نوسان تصادفی نسبی قیمت‌ها و bias انحراف ثابت نسبی یک منبع است
+    now = int(time.time())
+    payload = {}
+    for category, symbols in SAMPLE_SYMBOLS.items():
+        payload[category] = [
+            {'symbol': symbol, 'name': symbol, 'price': price * (1 + bias + random.uniform(-jitter, jitter)),
+             'time_unix': now, 'unit': 'تومان'}
+            for symbol, price in symbols.items()
+        ]
+    return payload
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line: return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''): break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, target, headers, body
+
+async def serve_http(handler, host='127.0.0.1', port=0):
+    # سرور HTTP/1.1 حداقلی با keep-alive؛ handler(method, path, query, headers, body) -> (status, dict)
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None: break
+                method, target, headers, body = request
+                parts = urlsplit(target)
+                status, payload = await handler(method, parts.path, parse_qs(parts.query), headers, body)
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+    server = await asyncio.start_server(on_connection, host, port)
+    return server, f"http://{host}:{server.sockets[0].getsockname()[1]}"
+
+def _parse_body(headers, body):
+    content_type = headers.get('content-type', '')
+    if not body: return {}
+    if content_type.startswith('application/json'): return json.loads(body)
+    if content_type.startswith('application/x-www-form-urlencoded'): return dict(parse_qsl(body.decode('utf-8')))
+    if content_type.startswith('multipart/form-data'):
+        # فقط فیلدهای متنی لازم است؛ فایل‌ها با کلید uploaded علامت می‌خورند
+        fields = dict(re.findall(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', body))
+        params = {key.decode(): value.decode('utf-8', 'replace') for key, value in fields.items()}
+        params['uploaded'] = b'filename=' in body
+        return params
+    return {}
+
+class FakeTelegram:
+    # جایگزین Bot API: همه متدها را پاسخ می‌دهد و پیام‌های ارسالی/ویرایشی را با زمان ثبت می‌کند
+    def __init__(self, latency=0.0):
+        self.latency, self.calls, self.sent, self.edited, self.photos = latency, {}, [], [], []
+        self.next_message_id, self.server, self.base_url = 1000, None, None
+    def _message(self, params):
+        self.next_message_id += 1
+        chat_id = int(params.get('chat_id', 0))
+        return {'message_id': self.next_message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+    async def handle(self, method, path, query, headers, body):
+        api_method = path.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency: await asyncio.sleep(self.latency)
+        params = _parse_body(headers, body)
+        if api_method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot', 'can_join_groups': False,
+                      'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        elif api_method == 'sendMessage':
+            result = self._message(params)
+            self.sent.append((time.perf_counter(), result['chat']['id']))
+        elif api_method == 'editMessageText':
+            result = self._message(params)
+            result['message_id'] = int(params.get('message_id', result['message_id']))
+            self.edited.append((time.perf_counter(), result['chat']['id']))
+        elif api_method == 'sendPhoto':
+            # آپلود واقعی یک file_id تازه می‌گیرد؛ ارسال با file_id همان شناسه را برمی‌گرداند
+            result, uploaded = self._message(params), bool(params.get('uploaded'))
+            file_id = f"photo-{result['message_id']}" if uploaded else params.get('photo', '')
+            result['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 450}]
+            self.photos.append((time.perf_counter(), result['chat']['id'], uploaded))
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+    async def start(self):
+        self.server, base_url = await serve_http(self.handle)
+        self.base_url = base_url + "/bot"
+        return self.base_url
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+class FakeBrsApi:
+    # latency: تأخیر پایه (ثانیه)، slow_rate/slow_latency: درصد پاسخ‌های کند، error_rate/error_status: درصد و کد پاسخ‌های خطا، bias: انحراف ثابت قیمت‌ها
+    def __init__(self, latency=0.0, slow_rate=0.0, slow_latency=10.0, error_rate=0.0, jitter=0.001, bias=0.0, error_status=503):
+        self.latency, self.slow_rate, self.slow_latency = latency, slow_rate, slow_latency
+        self.error_rate, self.error_status, self.jitter, self.bias = error_rate, error_status, jitter, bias
+        self.requests, self.errors, self.server, self.url = 0, 0, None, None
+    async def handle(self, method, path, query, headers, body):
+        self.requests += 1
+        await asyncio.sleep(self.slow_latency if random.random() < self.slow_rate else self.latency)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return self.error_status, {'error': 'injected failure'}
+        return 200, build_payload(self.jitter, self.bias)
+    async def start(self):
+        self.server, base_url = await serve_http(self.handle)
+        self.url = base_url + "/Api/Market/Gold_Currency.php"
+        return self.url
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# آزمون بار قابل تکرار: N کاربر هم‌زمان دکمه‌های منو را می‌زنند، تنظیمات را تغییر می‌دهند و گزارش زمان‌بندی‌شده دریافت می‌کنند.
+# BrsApi و Bot API تلگرام با سرورهای جایگزین محلی (fake_servers) شبیه‌سازی می‌شوند و نتیجه به صورت JSON ذخیره می‌شود.
+# اجرا از ریشه پروژه: python benchmarks/load_test.py --users 500 --output benchmarks/results/latest.json
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import bot
+from fake_servers import FakeBrsApi, FakeTelegram
+from telegram import Update
+from telegram.ext import Application, CallbackQueryHandler, MessageHandler, filters
+
+MENU_BUTTONS = ["💵 نرخ ارزها", "🪙 نرخ طلا و سکه", "📈 ارزهای دیجیتال", "🫧 تحلیل حباب"]
+
+def percentiles(samples):
+    if not samples: return {}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {'count': len(ordered), 'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99), 'max_ms': ordered[-1] * 1000}
+
+class LoopLagProbe:
+    def __init__(self, interval=0.005):
+        self.interval, self.samples, self.task = interval, [], None
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+    def start(self): self.task = asyncio.create_task(self._run())
+    async def stop(self):
+        self.task.cancel()
+        try: await self.task
+        except asyncio.CancelledError: pass
+
+class LoadTest:
+    def __init__(self, application, args):
+        self.application, self.args, self.update_id = application, args, 0
+        self.latencies = {'main_menu_handler': [], 'settings_callback_handler': []}
+        self.rng = random.Random(args.seed)
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+    def _next_id(self):
+        self.update_id += 1
+        return self.update_id
+    def message_update(self, user_id, text):
+        update_id = self._next_id()
+        return {'update_id': update_id, 'message': {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+                                                    'from': self._user(user_id), 'text': text}}
+    def callback_update(self, user_id, data):
+        update_id = self._next_id()
+        message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'text': "منوی تنظیمات:"}
+        return {'update_id': update_id, 'callback_query': {'id': str(update_id), 'from': self._user(user_id), 'chat_instance': str(user_id),
+                                                           'data': data, 'message': message}}
+    async def process(self, handler_name, payload):
+        update = Update.de_json(payload, self.application.bot)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies[handler_name].append(time.perf_counter() - started)
+    def random_action(self, user_id):
+        roll = self.rng.random()
+        if roll < 0.55: return 'main_menu_handler', self.message_update(user_id, self.rng.choice(MENU_BUTTONS))
+        if roll < 0.60: return 'main_menu_handler', self.message_update(user_id, "⚙️ تنظیمات")
+        category = self.rng.choice(list(bot.FULL_SYMBOL_LIST))
+        data = self.rng.choice([
+            f"settings_{category}", f"toggle_{category}_{self.rng.choice(list(bot.FULL_SYMBOL_LIST[category]))}", 'settings_schedule',
+            'schedule_set_time', f"schedule_toggle_time_{self.rng.randrange(24):02d}:00", 'schedule_toggle_active', 'settings_main',
+        ])
+        return 'settings_callback_handler', self.callback_update(user_id, data)
+    async def run_user(self, user_id):
+        for _ in range(self.args.actions_per_user):
+            await self.process(*self.random_action(user_id))
+            if self.args.think_time: await asyncio.sleep(self.rng.uniform(0, self.args.think_time))
+    async def run_interactive(self):
+        started = time.perf_counter()
+        await asyncio.gather(*(self.run_user(100000 + i) for i in range(self.args.users)))
+        return time.perf_counter() - started
+    async def run_scheduled_burst(self, fake_telegram):
+        slot = "03:33"
+        for i in range(self.args.users):
+            def subscribe(prefs): prefs['schedule'].update(active=True, times=[slot], reports=['currency', 'gold', 'bubble'])
+            bot.reindex_user_schedule(100000 + i, await bot.update_user_prefs(100000 + i, subscribe))
+        sent_before = len(fake_telegram.sent)
+        context = type("BurstContext", (), {'bot': self.application.bot})()
+        started = time.perf_counter()
+        await bot.deliver_slot(slot, context)
+        elapsed = time.perf_counter() - started
+        return len(fake_telegram.sent) - sent_before, elapsed
+
+def git_commit():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="hobab_load_")
+    bot.SETTINGS_DB_FILE, bot.HISTORY_DIR = os.path.join(workdir, "bot_data.db"), os.path.join(workdir, "price_history")
+    bot.USER_SETTINGS_FILE, bot.HOURLY_DATA_FILE = os.path.join(workdir, "user_settings.json"), os.path.join(workdir, "hourly_prices.json")
+    bot.PRICE_CACHE_TTL = args.price_ttl
+    bot.telegram_rate_limiter = bot.RateLimiter(args.telegram_rate, args.per_chat_interval)
+    fake_brsapi = FakeBrsApi(latency=args.brsapi_latency, error_rate=args.brsapi_error_rate)
+    fake_telegram = FakeTelegram(latency=args.telegram_latency)
+    bot.BRSAPI_URL = await fake_brsapi.start()
+    application = (Application.builder().token("123:BENCH").base_url(await fake_telegram.start())
+                   .connection_pool_size(256).pool_timeout(30).build())
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.main_menu_handler))
+    application.add_handler(CallbackQueryHandler(bot.settings_callback_handler))
+    await application.initialize()
+
+    load_test, probe = LoadTest(application, args), LoopLagProbe()
+    probe.start()
+    sent_before = len(fake_telegram.sent) + len(fake_telegram.edited)
+    interactive_elapsed = await load_test.run_interactive()
+    interactive_messages = len(fake_telegram.sent) + len(fake_telegram.edited) - sent_before
+    burst_messages, burst_elapsed = await load_test.run_scheduled_burst(fake_telegram)
+    await probe.stop()
+
+    await application.shutdown()
+    await bot.close_http_client()
+    await fake_brsapi.stop()
+    await fake_telegram.stop()
+
+    results = {
+        'commit': git_commit(), 'timestamp': time.time(), 'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'handlers': {name: percentiles(samples) for name, samples in load_test.latencies.items()},
+        'interactive': {'elapsed_s': interactive_elapsed, 'updates': sum(len(s) for s in load_test.latencies.values()),
+                        'updates_per_s': sum(len(s) for s in load_test.latencies.values()) / interactive_elapsed,
+                        'messages': interactive_messages, 'messages_per_s': interactive_messages / interactive_elapsed},
+        'scheduled_burst': {'messages': burst_messages, 'elapsed_s': burst_elapsed, 'messages_per_s': burst_messages / burst_elapsed if burst_elapsed else None},
+        'event_loop_lag': percentiles(probe.samples),
+        'upstream': {'brsapi_requests': fake_brsapi.requests, 'brsapi_errors': fake_brsapi.errors, 'telegram_calls': fake_telegram.calls},
+    }
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f: json.dump(results, f, indent=2, ensure_ascii=False)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test for Hobabbot handlers against local stand-in servers.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--actions-per-user", type=int, default=10)
+    parser.add_argument("--think-time", type=float, default=0.0, help="max random pause between a user's actions (s)")
+    parser.add_argument("--brsapi-latency", type=float, default=0.05)
+    parser.add_argument("--brsapi-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.002)
+    parser.add_argument("--telegram-rate", type=float, default=1000.0, help="global send rate limit used for the scheduled burst")
+    parser.add_argument("--per-chat-interval", type=float, default=1.0)
+    parser.add_argument("--price-ttl", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results JSON to this path")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -1,16 +1,34 @@
 # -*- coding: utf-8 -*-
 
-import requests
+import httpx
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import functools
+import io
 import json
+import math
 import os
+import mmap
+import multiprocessing
+import random
+import re
+import secrets
+import signal
+import sqlite3
+import struct
+import threading
 import time
 import jdatetime
+import numpy as np
 import pytz
-from datetime import datetime
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, KeyboardButton, InlineKeyboardButton
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.constants import ParseMode
 
 # --- بخش ۱: بارگذاری تنظیمات و متغیرهای اصلی ---
@@ -22,7 +40,59 @@ if not TELEGRAM_TOKEN or not BRSAPI_KEY:
     raise ValueError("خطای حیاتی: متغیرهای TELEGRAM_TOKEN یا BRSAPI_KEY در فایل .env یافت نشدند.")
 
 HOURLY_DATA_FILE = "hourly_prices.json"
+# تاریخچه قیمت‌ها: مدت نگهداری، سن فشرده‌سازی به یک نقطه در ساعت و حداقل فاصله دو نقطه پیاپی (ثانیه)
+HISTORY_DIR = os.getenv("HISTORY_DIR", "price_history")
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "1095"))
+HISTORY_COMPACT_AFTER_DAYS = int(os.getenv("HISTORY_COMPACT_AFTER_DAYS", "30"))
+HISTORY_MIN_INTERVAL = int(os.getenv("HISTORY_MIN_INTERVAL", "55"))
+CHANGE_PERIODS = [(3600, "1h"), (86400, "24h"), (7 * 86400, "7d")]
+# ضرایب ارزش ذاتی: intrinsic = gram_price_global * factor + fixed (وزن × عیار برای سکه‌ها به همراه هزینه ضرب)
+BUBBLE_ITEMS = {
+    'IR_COIN_EMAMI': (8.133 * 0.900, 300000), 'IR_COIN_BAHAR': (8.133 * 0.900, 300000),
+    'IR_COIN_HALF': (4.0665 * 0.900, 150000), 'IR_COIN_QUARTER': (2.03325 * 0.900, 100000),
+    'IR_GOLD_18K': (0.75, 0), 'IR_GOLD_MESGHAL': (0.75 * 4.6083, 0)
+}
+BUBBLE_ROLLING_DAYS = int(os.getenv("BUBBLE_ROLLING_DAYS", "30"))
+BUBBLE_MIN_HISTORY_POINTS = 100
+# هشدارهای قیمت: حداکثر تعداد برای هر کاربر و تعداد ارسال‌کننده‌های هم‌زمان
+MAX_ALERTS_PER_USER = int(os.getenv("MAX_ALERTS_PER_USER", "20"))
+ALERT_DISPATCH_WORKERS = int(os.getenv("ALERT_DISPATCH_WORKERS", "20"))
 USER_SETTINGS_FILE = "user_settings.json"
+SETTINGS_DB_FILE = os.getenv("SETTINGS_DB_FILE", "bot_data.db")
+# عمر قیمت‌های کش‌شده (ثانیه) و بازه‌ای که پس از آن داده کهنه همچنان سرو شده و در پس‌زمینه تازه می‌شود
+PRICE_CACHE_TTL = int(os.getenv("PRICE_CACHE_TTL", "60"))
+PRICE_CACHE_STALE = int(os.getenv("PRICE_CACHE_STALE", "300"))
+# تنظیمات کلاینت HTTP: مهلت هر تلاش، تعداد تلاش‌ها، پایه بازه انتظار و قطع‌کننده مدار
+BRSAPI_URL = os.getenv("BRSAPI_URL", "https://BrsApi.ir/Api/Market/Gold_Currency.php")
+FETCH_ATTEMPT_TIMEOUT = float(os.getenv("FETCH_ATTEMPT_TIMEOUT", "5"))
+FETCH_MAX_ATTEMPTS = int(os.getenv("FETCH_MAX_ATTEMPTS", "3"))
+FETCH_BACKOFF_BASE, FETCH_BACKOFF_CAP = 0.5, 4.0
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+# منابع قیمت: BrsApi همیشه اولین منبع است و منابع بیشتر با PRICE_PROVIDERS به صورت JSON اضافه می‌شوند، مثلاً
+# [{"name": "mirror", "url": "https://mirror.example/Gold_Currency.php", "params": {"key": "..."}, "format": "brsapi"}]
+PRICE_PROVIDERS = os.getenv("PRICE_PROVIDERS", "")
+# ادغام: median یا freshest، آستانه فاصله نسبی از میانه برای پرت شمردن یک منبع و مهلت انتظار برای بقیه منابع پس از اولین پاسخ (ثانیه)
+PRICE_MERGE_MODE = os.getenv("PRICE_MERGE_MODE", "median")
+PRICE_OUTLIER_THRESHOLD = float(os.getenv("PRICE_OUTLIER_THRESHOLD", "0.02"))
+PRICE_MERGE_GRACE = float(os.getenv("PRICE_MERGE_GRACE", "0.3"))
+# درخواست پشتیبان (hedge): اگر پاسخ یک منبع تا صدک HEDGE_PERCENTILE تأخیرهای اخیرش نرسد، درخواست دوم هم فرستاده می‌شود
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_INITIAL_DELAY, HEDGE_MIN_DELAY, HEDGE_MIN_SAMPLES, HEDGE_LATENCY_WINDOW, HEDGE_MAX_EXTRA = 1.0, 0.05, 20, 200, 2
+# محدودیت‌های ارسال تلگرام (پیام در ثانیه در کل ربات و فاصله پیام‌ها در هر چت) و تنظیمات زمان‌بند
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_PER_CHAT_INTERVAL = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL", "1"))
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "50"))
+SCHEDULER_MAX_CATCHUP_MINUTES = int(os.getenv("SCHEDULER_MAX_CATCHUP_MINUTES", "180"))
+# تیکر زنده: فاصله نظرسنجی قیمت، حداقل فاصله ویرایش هر پیام و سقف ویرایش در ثانیه برای همه تیکرها (سهمی از TELEGRAM_GLOBAL_RATE)
+TICKER_POLL_INTERVAL = int(os.getenv("TICKER_POLL_INTERVAL", "20"))
+TICKER_MIN_EDIT_INTERVAL = float(os.getenv("TICKER_MIN_EDIT_INTERVAL", "5"))
+TICKER_EDIT_RATE = float(os.getenv("TICKER_EDIT_RATE", "15"))
+# نمودارها: بازه‌های مجاز، تعداد پردازه‌های رسم، ظرفیت کش تصویرها، حداکثر نماد در یک نمودار و حداکثر نقطه هر خط
+CHART_RANGES = {'1d': 86400, '7d': 7 * 86400, '30d': 30 * 86400, '90d': 90 * 86400, '1y': 365 * 86400}
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "2"))
+CHART_CACHE_MAX_ENTRIES = int(os.getenv("CHART_CACHE_MAX_ENTRIES", "256"))
+CHART_MAX_SYMBOLS, CHART_MAX_POINTS = 4, 1000
 
 FULL_SYMBOL_LIST = {
     'gold': {
@@ -48,86 +118,856 @@ FULL_SYMBOL_LIST = {
     }
 }
 REPORT_TYPES = {"currency": "💵 نرخ ارزها", "gold": "🪙 نرخ طلا و سکه", "crypto": "📈 ارزهای دیجیتال", "bubble": "🫧 تحلیل حباب"}
+# متریک‌ها: پورت endpoint پرومتئوس (۰ یعنی غیرفعال) و شناسه مدیرانی که به /stats دسترسی دارند
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+# حالت وب‌هوک: با تعیین WEBHOOK_URL به جای polling یک مسیریاب محلی روی WEBHOOK_PORT به‌روزرسانی‌ها را بر اساس شناسه کاربر فرستنده
+# (و فقط برای به‌روزرسانی‌های بدون فرستنده بر اساس شناسه چت) بین WEBHOOK_WORKERS پردازه پخش می‌کند
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+WEBHOOK_WORKER_BASE_PORT = int(os.getenv("WEBHOOK_WORKER_BASE_PORT", "9100"))
+# آدرس سرور Bot API محلی (اختیاری)، مثلاً http://127.0.0.1:8081/bot
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "")
+CLUSTER_POLL_INTERVAL = 0.2
+# شماره این پردازه و تعداد کل کارگرها؛ در حالت polling همیشه 0 و 1 است و فقط run_worker آن‌ها را تغییر می‌دهد
+WORKER_INDEX, WORKER_COUNT = 0, 1
+
+# --- متریک‌ها: شمارنده‌ها و هیستوگرام‌های سبک در حافظه با خروجی متنی پرومتئوس ---
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help_text, self.labelnames, self.values = name, help_text, labelnames, {}
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    def total(self):
+        return sum(self.values.values())
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in sorted(self.values.items())]
+        return lines
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help_text, self.labelnames, self.buckets, self.values = name, help_text, labelnames, buckets, {}
+    def observe(self, value, *labels):
+        # هزینه هر مشاهده: یک جستجوی دودویی و سه جمع
+        state = self.values.get(labels)
+        if state is None: state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+    def quantile(self, q, *labels):
+        # تخمین صدک با درون‌یابی خطی داخل سطل
+        state = self.values.get(labels)
+        if not state or not state[2]: return None
+        rank, cumulative = q * state[2], 0
+        for index, count in enumerate(state[0]):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames + ('le',), labels + ('+Inf' if bound == float('inf') else repr(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+class Gauge:
+    # مقدار لحظه‌ای که هنگام خروجی گرفتن با تابع محاسبه می‌شود
+    def __init__(self, name, help_text, function):
+        self.name, self.help_text, self.function = name, help_text, function
+    def render(self):
+        try: value = self.function()
+        except Exception: return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value}"] if value is not None else []
+def _format_labels(names, values):
+    if not names: return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+METRICS = []
+def _register(metric):
+    METRICS.append(metric)
+    return metric
+HANDLER_LATENCY = _register(Histogram("hobab_handler_latency_seconds", "Telegram update handler latency.", ("handler",)))
+HANDLER_ERRORS = _register(Counter("hobab_handler_errors_total", "Exceptions raised by update handlers.", ("handler", "error")))
+UPSTREAM_FETCH_LATENCY = _register(Histogram("hobab_upstream_fetch_seconds", "Latency of each price provider request.", ("provider", "outcome")))
+UPSTREAM_FETCH_ERRORS = _register(Counter("hobab_upstream_fetch_errors_total", "Failed price provider requests by error type.", ("provider", "error")))
+CHART_RENDER_LATENCY = _register(Histogram("hobab_chart_render_seconds", "Chart rendering time in the process pool, including queueing."))
+HEDGED_REQUESTS = _register(Counter("hobab_hedged_requests_total", "Hedged provider requests sent and won.", ("provider", "result")))
+PRICE_OUTLIERS = _register(Counter("hobab_price_outliers_total", "Symbol prices rejected as outliers when merging providers.", ("provider",)))
+CACHE_REQUESTS = _register(Counter("hobab_cache_requests_total", "Cache lookups by cache and result.", ("cache", "result")))
+SETTINGS_IO_LATENCY = _register(Histogram("hobab_settings_io_seconds", "User settings store I/O time.", ("operation",)))
+SCHEDULER_LAG = _register(Histogram("hobab_scheduler_lag_seconds", "Delay between a schedule slot and the actual send.",
+                                    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)))
+TELEGRAM_SEND_FAILURES = _register(Counter("hobab_telegram_send_failures_total", "Failed Telegram sends by error type.", ("error",)))
+MESSAGES_SENT = _register(Counter("hobab_messages_sent_total", "Rate-limited messages sent by kind.", ("kind",)))
+
+def instrument_handler(handler):
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception as e:
+            HANDLER_ERRORS.inc(handler.__name__, type(e).__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler.__name__)
+    return wrapper
+def render_metrics():
+    lines = []
+    for metric in METRICS: lines += metric.render()
+    return "\n".join(lines) + "\n"
+async def _serve_metrics_connection(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''): pass
+        path = request_line.decode('latin-1').split(' ')[1] if request_line.count(b' ') >= 2 else ''
+        status, body = ("200 OK", render_metrics()) if path.split('?')[0] == '/metrics' else ("404 Not Found", "not found\n")
+        data = body.encode('utf-8')
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+async def start_metrics_server():
+    if not METRICS_PORT: return None
+    server = await asyncio.start_server(_serve_metrics_connection, METRICS_HOST, METRICS_PORT)
+    print(f"Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
 
 # --- بخش ۲: توابع مدیریت داده و API ---
 async def update_hourly_data(context: ContextTypes.DEFAULT_TYPE):
+    # هر اسنپ‌شات تازه خودکار در تاریخچه ثبت می‌شود؛ این کار ساعتی فقط نقطه تازه، نگهداری و فشرده‌سازی را تضمین می‌کند
+    # ادعا پیش از اجرا ثبت می‌شود تا فقط یک کارگر اجرا کند؛ اگر آن کارگر وسط کار از کار بیفتد این ساعت تکرار نمی‌شود
+    # و نقطه تاریخچه و نگهداری به ساعت بعد (یا اولین اسنپ‌شات تازه) موکول می‌شود
+    if WORKER_COUNT > 1:
+        if not await asyncio.to_thread(claim_job_slot, 'hourly', time.strftime('%Y-%m-%d %H', time.gmtime())): return
+        await asyncio.to_thread(prune_job_runs, time.time() - 2 * 86400)
     print(f"Running hourly job at {time.strftime('%Y-%m-%d %H:%M:%S')}...")
-    prices = get_and_process_prices(BRSAPI_KEY)
-    if prices:
-        with open(HOURLY_DATA_FILE, 'w', encoding='utf-8') as f: json.dump({"timestamp": time.time(), "prices": prices}, f, ensure_ascii=False, indent=4)
-        print("Hourly data successfully updated.")
+    snapshot = await get_price_snapshot(force=True)
+    if snapshot and time.time() - snapshot['fetched_at'] < PRICE_CACHE_TTL: print("Hourly data successfully updated.")
     else: print("Failed to update hourly data: API call failed.")
-def read_hourly_prices():
-    if not os.path.exists(HOURLY_DATA_FILE): return {}
-    try:
-        with open(HOURLY_DATA_FILE, 'r', encoding='utf-8') as f: return json.load(f).get("prices", {})
-    except: return {}
-def load_user_settings():
-    if not os.path.exists(USER_SETTINGS_FILE): return {}
-    try:
-        with open(USER_SETTINGS_FILE, 'r', encoding='utf-8') as f: return json.load(f)
-    except: return {}
-def save_user_settings(all_settings):
-    with open(USER_SETTINGS_FILE, 'w', encoding='utf-8') as f: json.dump(all_settings, f, indent=4, ensure_ascii=False)
-def get_user_prefs(user_id):
-    all_settings = load_user_settings()
-    user_id_str = str(user_id)
-    if user_id_str not in all_settings:
-        all_settings[user_id_str] = {
-            "currency": ['USD', 'EUR', 'AED', 'USDT_IRT'], "gold": ['IR_COIN_EMAMI', 'IR_GOLD_18K'],
-            "crypto": ['BTC', 'ETH'], "schedule": {"active": False, "times": ["09:00"], "reports": ["gold", "bubble"]}
+    history = get_price_history()
+    removed, compacted = await asyncio.to_thread(history.maintain, time.time())
+    if removed or compacted: print(f"Price history maintenance: removed {removed} segments, compacted {compacted} segments.")
+
+# --- تاریخچه قیمت: بخش‌های ماهانه فقط-افزودنی با رکوردهای ثابت (timestamp, price) برای هر نماد، نگاشت‌شده با mmap ---
+def _synchronized(method):
+    # نوشتن و نگهداری در نخ جدا اجرا می‌شوند؛ قفل مانع بسته شدن نگاشتی می‌شود که خواننده دیگری در حال استفاده از آن است
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock: return method(self, *args, **kwargs)
+    return wrapper
+class PriceHistory:
+    RECORD = struct.Struct('<dd')
+    SYMBOL_PATTERN = re.compile(r'^[A-Za-z0-9_]+$')
+    def __init__(self, directory, retention_days=HISTORY_RETENTION_DAYS, compact_after_days=HISTORY_COMPACT_AFTER_DAYS, min_interval=HISTORY_MIN_INTERVAL):
+        self.directory, self.retention_days, self.compact_after_days, self.min_interval = directory, retention_days, compact_after_days, min_interval
+        os.makedirs(directory, exist_ok=True)
+        self._maps, self._segments, self._last_timestamp, self._lock = {}, {}, {}, threading.RLock()
+    @staticmethod
+    def _segment_name(timestamp):
+        tm = time.gmtime(timestamp)
+        return f"{tm.tm_year:04d}{tm.tm_mon:02d}.bin"
+    def symbols(self):
+        return sorted(name for name in os.listdir(self.directory) if self.SYMBOL_PATTERN.match(name))
+    @_synchronized
+    def invalidate(self):
+        # وقتی پردازه دیگری در تاریخچه نوشته است، فهرست بخش‌ها و آخرین زمان هر نماد دوباره از دیسک خوانده می‌شود
+        self._segments, self._last_timestamp = {}, {}
+    def segments(self, symbol):
+        if symbol not in self._segments:
+            symbol_dir = os.path.join(self.directory, symbol)
+            self._segments[symbol] = sorted(name for name in os.listdir(symbol_dir) if name.endswith('.bin')) if os.path.isdir(symbol_dir) else []
+        return self._segments[symbol]
+    def _map(self, symbol, segment):
+        # فایل فقط نگاشت می‌شود و اگر از آخرین نگاشت بزرگ‌تر شده باشد دوباره نگاشت می‌شود
+        path = os.path.join(self.directory, symbol, segment)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        size -= size % self.RECORD.size
+        cached = self._maps.get(path)
+        if cached and cached[0] == size: return cached[1], size // self.RECORD.size
+        self._drop_map(path)
+        if size == 0: return None, 0
+        with open(path, 'rb') as f: mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        self._maps[path] = (size, mapped)
+        return mapped, size // self.RECORD.size
+    def _drop_map(self, path):
+        cached = self._maps.pop(path, None)
+        if cached is None: return
+        try: cached[1].close()
+        except BufferError: pass  # هنوز آرایه‌ای از NumPy به آن اشاره می‌کند؛ با آزاد شدن آرایه بسته می‌شود
+    def _bisect(self, mapped, count, timestamp):
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            value = struct.unpack_from('<d', mapped, mid * self.RECORD.size)[0]
+            if value <= timestamp: low = mid + 1
+            else: high = mid
+        return low
+    @_synchronized
+    def last_timestamp(self, symbol):
+        if symbol not in self._last_timestamp:
+            self._last_timestamp[symbol] = None
+            for segment in reversed(self.segments(symbol)):
+                mapped, count = self._map(symbol, segment)
+                if count:
+                    self._last_timestamp[symbol] = self.RECORD.unpack_from(mapped, (count - 1) * self.RECORD.size)[0]
+                    break
+        return self._last_timestamp[symbol]
+    @_synchronized
+    def append(self, timestamp, prices):
+        # prices: {symbol: price}؛ نقاطی که از حداقل فاصله نزدیک‌ترند یا به ترتیب زمانی نیستند نادیده گرفته می‌شوند.
+        # حدود ۴۰ فایل باز و نوشته می‌شود؛ از حلقه رویداد با asyncio.to_thread صدا زده می‌شود
+        written, segment = 0, self._segment_name(timestamp)
+        for symbol, price in prices.items():
+            if not self.SYMBOL_PATTERN.match(symbol): continue
+            last = self.last_timestamp(symbol)
+            if last is not None and timestamp < last + self.min_interval: continue
+            os.makedirs(os.path.join(self.directory, symbol), exist_ok=True)
+            with open(os.path.join(self.directory, symbol, segment), 'ab') as f: f.write(self.RECORD.pack(timestamp, float(price)))
+            segments = self.segments(symbol)
+            if not segments or segments[-1] != segment: segments.append(segment)
+            self._last_timestamp[symbol] = timestamp
+            written += 1
+        return written
+    @_synchronized
+    def arrays(self, symbol):
+        # کل تاریخچه یک نماد به صورت دو آرایه NumPy (زمان، قیمت)؛ داده‌ها از نگاشت‌ها کپی می‌شوند
+        chunks = []
+        for segment in self.segments(symbol):
+            mapped, count = self._map(symbol, segment)
+            if count: chunks.append(np.frombuffer(mapped, dtype='<f8', count=count * 2).reshape(count, 2))
+        if not chunks: return np.empty(0), np.empty(0)
+        records = np.concatenate(chunks)
+        return records[:, 0].copy(), records[:, 1].copy()
+    @_synchronized
+    def range(self, symbol, start, end):
+        # همه نقاط با start <= timestamp <= end به ترتیب زمانی، به صورت دو آرایه NumPy (زمان، قیمت) و بدون حلقه پایتونی
+        chunks, first, last = [], self._segment_name(start), self._segment_name(end)
+        for segment in self.segments(symbol):
+            if segment < first or segment > last: continue
+            mapped, count = self._map(symbol, segment)
+            if count: chunks.append(np.frombuffer(mapped, dtype='<f8', count=count * 2).reshape(count, 2))
+        if not chunks: return np.empty(0), np.empty(0)
+        records = np.concatenate(chunks)
+        low, high = np.searchsorted(records[:, 0], start, 'left'), np.searchsorted(records[:, 0], end, 'right')
+        return records[low:high, 0].copy(), records[low:high, 1].copy()
+    @_synchronized
+    def price_at(self, symbol, timestamp, max_age=None):
+        # آخرین قیمت ثبت‌شده در زمان timestamp یا قبل از آن؛ اگر آن نقطه بیش از max_age ثانیه قدیمی‌تر باشد None
+        target = self._segment_name(timestamp)
+        for segment in reversed(self.segments(symbol)):
+            if segment > target: continue
+            mapped, count = self._map(symbol, segment)
+            index = self._bisect(mapped, count, timestamp) if count else 0
+            if index:
+                point_time, price = self.RECORD.unpack_from(mapped, (index - 1) * self.RECORD.size)
+                return price if max_age is None or timestamp - point_time <= max_age else None
+        return None
+    @_synchronized
+    def maintain(self, now):
+        # حذف بخش‌های قدیمی‌تر از مدت نگهداری و کاهش بخش‌های قدیمی به آخرین نقطه هر ساعت
+        removed, compacted = 0, 0
+        retention_segment, compact_segment = self._segment_name(now - self.retention_days * 86400), self._segment_name(now - self.compact_after_days * 86400)
+        for symbol in self.symbols():
+            for segment in list(self.segments(symbol)):
+                path = os.path.join(self.directory, symbol, segment)
+                if segment < retention_segment:
+                    self._drop_map(path)
+                    os.remove(path)
+                    self.segments(symbol).remove(segment)
+                    removed += 1
+                elif segment < compact_segment and self._compact(symbol, segment, path): compacted += 1
+        return removed, compacted
+    def _compact(self, symbol, segment, path):
+        mapped, count = self._map(symbol, segment)
+        if count <= 31 * 24: return False
+        hourly = {}
+        for index in range(count):
+            timestamp, price = self.RECORD.unpack_from(mapped, index * self.RECORD.size)
+            hourly[int(timestamp // 3600)] = (timestamp, price)
+        if len(hourly) == count: return False
+        with open(path + '.tmp', 'wb') as f: f.write(b''.join(self.RECORD.pack(*point) for point in hourly.values()))
+        self._drop_map(path)
+        os.replace(path + '.tmp', path)
+        return True
+    def import_legacy_snapshot(self, json_path):
+        # انتقال یک‌باره آخرین اسنپ‌شات hourly_prices.json به تاریخچه خالی
+        if self.symbols() or not os.path.exists(json_path): return 0
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f: data = json.load(f)
+            return self.append(data['timestamp'], {symbol: item['price'] for symbol, item in data.get('prices', {}).items()})
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Skipping legacy hourly import from {json_path}: {e}")
+            return 0
+
+_price_history = None
+def get_price_history():
+    global _price_history
+    if _price_history is None:
+        _price_history = PriceHistory(HISTORY_DIR)
+        _price_history.import_legacy_snapshot(HOURLY_DATA_FILE)
+    return _price_history
+
+# --- موتور تحلیل تاریخی حباب با NumPy: محاسبه یکجای حباب روی کل تاریخچه و به‌روزرسانی افزایشی ---
+class _BubbleSeries:
+    # آرایه‌های قابل رشد زمان و درصد حباب به همراه مجموع تجمعی و مجموع مربعات برای آمار پنجره‌ای در O(log n)
+    def __init__(self, timestamps, values):
+        count = len(values)
+        capacity = max(1024, count * 2)
+        self.t, self.v = np.empty(capacity), np.empty(capacity)
+        self.sum1, self.sum2 = np.zeros(capacity + 1), np.zeros(capacity + 1)
+        self.t[:count], self.v[:count] = timestamps, values
+        np.cumsum(values, out=self.sum1[1:count + 1])
+        np.cumsum(np.square(values), out=self.sum2[1:count + 1])
+        self.count = count
+    def append(self, timestamp, value):
+        if self.count and timestamp <= self.t[self.count - 1]: return
+        if self.count == len(self.t):
+            for name in ('t', 'v', 'sum1', 'sum2'):
+                old = getattr(self, name)
+                grown = np.zeros(len(old) * 2 if name in ('t', 'v') else (len(old) - 1) * 2 + 1)
+                grown[:len(old)] = old
+                setattr(self, name, grown)
+        index = self.count
+        self.t[index], self.v[index] = timestamp, value
+        self.sum1[index + 1], self.sum2[index + 1] = self.sum1[index] + value, self.sum2[index] + value * value
+        self.count += 1
+    def stats(self, window_seconds):
+        count = self.count
+        current, now = self.v[count - 1], self.t[count - 1]
+        start = int(np.searchsorted(self.t[:count], now - window_seconds, side='left'))
+        window = count - start
+        mean = (self.sum1[count] - self.sum1[start]) / window
+        std = max(0.0, (self.sum2[count] - self.sum2[start]) / window - mean * mean) ** 0.5
+        # همه آماره‌های نمایش‌داده‌شده از همان پنجره‌اند؛ points/since فقط کل تاریخچه موجود را توصیف می‌کنند
+        values = self.v[start:count]
+        return {
+            'current': float(current), 'rolling_mean': float(mean), 'rolling_std': float(std),
+            'z_score': float((current - mean) / std) if std > 1e-9 else 0.0,
+            'percentile_rank': float(np.count_nonzero(values <= current) * 100.0 / window),
+            'min': float(values.min()), 'max': float(values.max()), 'window_points': window, 'points': count, 'since': float(self.t[0]),
         }
-        save_user_settings(all_settings)
-    if "schedule" not in all_settings[user_id_str] or "times" not in all_settings[user_id_str]["schedule"]:
-        all_settings[user_id_str]["schedule"] = {"active": False, "times": ["09:00"], "reports": ["gold", "bubble"]}
+
+class BubbleAnalytics:
+    def __init__(self, history, start=None, end=None):
+        # start/end فقط برای نمودارها: تنها همین بازه (با یک هفته پیش از آن برای آخرین قیمت انس و دلار) خوانده می‌شود
+        self.series = {}
+        read = history.arrays if start is None else lambda symbol: history.range(symbol, start - 7 * 86400, end)
+        ounce_t, ounce_p = read('XAUUSD')
+        dollar_t, dollar_p = read('USD')
+        if not len(ounce_t) or not len(dollar_t): return
+        for symbol, (factor, fixed) in BUBBLE_ITEMS.items():
+            market_t, market_p = read(symbol)
+            if not len(market_t): continue
+            # آخرین قیمت انس و دلار در زمان هر نقطه (forward-fill) با searchsorted برای کل تاریخچه به صورت یکجا
+            ounce_idx = np.searchsorted(ounce_t, market_t, side='right') - 1
+            dollar_idx = np.searchsorted(dollar_t, market_t, side='right') - 1
+            valid = (ounce_idx >= 0) & (dollar_idx >= 0)
+            gram_price_global = ounce_p[ounce_idx[valid]] * dollar_p[dollar_idx[valid]] / 31.1035
+            intrinsic = gram_price_global * factor + fixed
+            percent = (market_p[valid] - intrinsic) / intrinsic * 100
+            self.series[symbol] = _BubbleSeries(market_t[valid], percent)
+    def append(self, timestamp, prices):
+        bubbles = calculate_all_bubbles(prices, quiet=True) or {}
+        for symbol, data in bubbles.items():
+            if symbol in self.series: self.series[symbol].append(timestamp, data['percent'])
+            else: self.series[symbol] = _BubbleSeries(np.array([timestamp]), np.array([data['percent']]))
+    def stats(self, symbol, window_days=BUBBLE_ROLLING_DAYS):
+        series = self.series.get(symbol)
+        if series is None or series.count == 0: return None
+        return series.stats(window_days * 86400)
+
+_bubble_analytics = None
+def get_bubble_analytics():
+    global _bubble_analytics
+    if _bubble_analytics is None: _bubble_analytics = BubbleAnalytics(get_price_history())
+    return _bubble_analytics
+def describe_bubble_history(stats):
+    if not stats or stats['window_points'] < BUBBLE_MIN_HISTORY_POINTS: return ""
+    percentile = stats['percentile_rank']
+    level = "پایین‌تر از معمول" if percentile < 20 else "بالاتر از معمول" if percentile > 80 else "در محدوده معمول"
+    return (f"در مقایسه با {BUBBLE_ROLLING_DAYS} روز گذشته، حباب فعلی <b>{level}</b> است: میانگین <code>{stats['rolling_mean']:+.2f}%</code>، "
+            f"صدک <code>{percentile:.0f}</code> و فاصله از میانگین <code>{stats['z_score']:+.2f}σ</code>.")
+_reference_prices_cache = (None, {})
+def get_reference_prices(snapshot):
+    # قیمت‌های ۱ ساعت، ۲۴ ساعت و ۷ روز پیش نسبت به زمان اسنپ‌شات، یک بار برای هر نسخه؛ نقطه‌ای که بیش از
+    # نصف دوره از زمان هدف فاصله داشته باشد (پس از وقفه یا فقط نقطه قدیمی وارد‌شده) مبنای تغییر قرار نمی‌گیرد
+    global _reference_prices_cache
+    if _reference_prices_cache[0] != snapshot['version']:
+        history = get_price_history()
+        references = {}
+        for period, _ in CHANGE_PERIODS:
+            target = snapshot['fetched_at'] - period
+            references[period] = {symbol: price for symbol in snapshot['prices'] if (price := history.price_at(symbol, target, period / 2)) is not None}
+        _reference_prices_cache = (snapshot['version'], references)
+    return _reference_prices_cache[1]
+
+# --- ذخیره‌سازی تنظیمات کاربران در SQLite (حالت WAL) با کش خواندنی در حافظه ---
+class SettingsStore:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS user_settings (user_id TEXT PRIMARY KEY, prefs TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('settings_version', '0')")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tickers (chat_id TEXT PRIMARY KEY, message_id INTEGER NOT NULL, category TEXT NOT NULL)")
+        self.cache, self.fully_loaded, self.data_version, self.settings_version = {}, False, None, None
+        # نوشتن‌ها در نخ جدا و با اتصال جدا انجام می‌شوند تا تراکنش‌های اتصال اصلی (هماهنگی پردازه‌ها) را قطع نکنند
+        self._write_conn, self._write_lock = None, threading.Lock()
+    def _check_external_changes(self):
+        # PRAGMA data_version فقط با کامیت اتصال‌های دیگر تغییر می‌کند؛ اگر شمارنده تنظیمات هم تغییر کرده باشد
+        # (نوشتن پردازه دیگر) کش دور ریخته می‌شود تا ردیف‌ها دوباره از دیتابیس خوانده شوند
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version: return
+        self.data_version = data_version
+        settings_version = self.conn.execute("SELECT value FROM meta WHERE key = 'settings_version'").fetchone()[0]
+        if settings_version != self.settings_version: self.cache, self.fully_loaded, self.settings_version = {}, False, settings_version
+    def _writer(self):
+        # فقط زیر _write_lock صدا زده می‌شود
+        if self._write_conn is None: self._write_conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        return self._write_conn
+    def write(self, sql, params):
+        # یک دستور تکی (مثل ردیف‌های tickers) روی اتصال نوشتن؛ مسدودکننده است و با asyncio.to_thread صدا زده می‌شود
+        with self._write_lock: return self._writer().execute(sql, params).rowcount
+    def get(self, user_id):
+        user_id_str = str(user_id)
+        self._check_external_changes()
+        if user_id_str in self.cache or self.fully_loaded:
+            CACHE_REQUESTS.inc('settings', 'hit')
+            return self.cache.get(user_id_str)
+        CACHE_REQUESTS.inc('settings', 'miss')
+        started = time.perf_counter()
+        row = self.conn.execute("SELECT prefs FROM user_settings WHERE user_id = ?", (user_id_str,)).fetchone()
+        SETTINGS_IO_LATENCY.observe(time.perf_counter() - started, 'read')
+        if row: self.cache[user_id_str] = json.loads(row[0])
+        return self.cache.get(user_id_str)
+    def all(self):
+        self._check_external_changes()
+        if not self.fully_loaded:
+            started = time.perf_counter()
+            for user_id_str, prefs in self.conn.execute("SELECT user_id, prefs FROM user_settings"): self.cache[user_id_str] = json.loads(prefs)
+            self.fully_loaded = True
+            SETTINGS_IO_LATENCY.observe(time.perf_counter() - started, 'load_all')
+        return self.cache
+    def update(self, user_id, mutate, default=None):
+        # خواندن، تغییر و نوشتن یک کاربر در یک تراکنش؛ ردیف از دیتابیس خوانده می‌شود تا تغییرات پردازه‌های دیگر گم نشود.
+        # مسدودکننده است (تا ۳۰ ثانیه انتظار قفل)؛ از حلقه رویداد با update_user_prefs و asyncio.to_thread صدا زده می‌شود
+        user_id_str = str(user_id)
+        started = time.perf_counter()
+        with self._write_lock:
+            conn = self._writer()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT prefs FROM user_settings WHERE user_id = ?", (user_id_str,)).fetchone()
+                prefs = json.loads(row[0]) if row else default()
+                mutate(prefs)
+                conn.execute("INSERT OR REPLACE INTO user_settings (user_id, prefs) VALUES (?, ?)", (user_id_str, json.dumps(prefs, ensure_ascii=False)))
+                previous_version = conn.execute("SELECT value FROM meta WHERE key = 'settings_version'").fetchone()[0]
+                conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'settings_version'")
+                settings_version = conn.execute("SELECT value FROM meta WHERE key = 'settings_version'").fetchone()[0]
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                SETTINGS_IO_LATENCY.observe(time.perf_counter() - started, 'update')
+            # نوشتن خود این پردازه کش را باطل نمی‌کند؛ ولی اگر پیش از آن شمارنده را پردازه دیگری جلو برده باشد
+            # (و هنوز در _check_external_changes دیده نشده) کش مثل همان‌جا دور ریخته می‌شود، وگرنه آن تغییر هرگز دیده نمی‌شد
+            if previous_version != self.settings_version: self.cache, self.fully_loaded = {}, False
+            self.settings_version = settings_version
+            self.cache[user_id_str] = prefs
+        return prefs
+    def migrate_from_json(self, json_path):
+        # انتقال یک‌باره از user_settings.json؛ فایل اصلی دست‌نخورده باقی می‌ماند
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone(): return 0
+        all_settings = {}
+        if os.path.exists(json_path):
+            try:
+                with open(json_path, 'r', encoding='utf-8') as f: all_settings = json.load(f)
+            except ValueError as e: print(f"Skipping settings migration, {json_path} is not valid JSON: {e}")
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("INSERT OR IGNORE INTO user_settings (user_id, prefs) VALUES (?, ?)",
+                              ((str(user_id), json.dumps(prefs, ensure_ascii=False)) for user_id, prefs in all_settings.items()))
+        self.conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)", (str(time.time()),))
+        self.conn.execute("COMMIT")
+        if all_settings: print(f"Migrated {len(all_settings)} users from {json_path} to {self.path}.")
+        return len(all_settings)
+
+_settings_store = None
+def get_settings_store():
+    global _settings_store
+    if _settings_store is None:
+        _settings_store = SettingsStore(SETTINGS_DB_FILE)
+        _settings_store.migrate_from_json(USER_SETTINGS_FILE)
+    return _settings_store
+def default_user_prefs():
+    return {
+        "currency": ['USD', 'EUR', 'AED', 'USDT_IRT'], "gold": ['IR_COIN_EMAMI', 'IR_GOLD_18K'],
+        "crypto": ['BTC', 'ETH'], "schedule": {"active": False, "times": ["09:00"], "reports": ["gold", "bubble"]}
+    }
+def _normalize_user_prefs(prefs):
+    if "schedule" not in prefs or "times" not in prefs["schedule"]:
+        prefs["schedule"] = {"active": False, "times": ["09:00"], "reports": ["gold", "bubble"]}
     for cat in FULL_SYMBOL_LIST:
-        if cat not in all_settings[user_id_str]: all_settings[user_id_str][cat] = []
-    return all_settings[user_id_str]
-def get_and_process_prices(api_key):
-    url = "https://BrsApi.ir/Api/Market/Gold_Currency.php"
-    params = {'key': api_key}
-    headers = {'User-Agent': 'Mozilla/5.0 (compatible; MyGoldBot/4.4)'}
+        if cat not in prefs: prefs[cat] = []
+    return prefs
+def load_user_settings():
+    return get_settings_store().all()
+def get_user_prefs(user_id):
+    store = get_settings_store()
+    prefs = store.get(user_id)
+    return _normalize_user_prefs(prefs if prefs is not None else default_user_prefs())
+async def update_user_prefs(user_id, mutate):
+    return await asyncio.to_thread(get_settings_store().update, user_id, lambda prefs: mutate(_normalize_user_prefs(prefs)), default_user_prefs)
+
+# --- هماهنگی پردازه‌های کارگر از طریق پایگاه داده مشترک: مالکیت چت‌ها، ادعای نوبت کارها، قفل اجاره‌ای و اسنپ‌شات مشترک ---
+# اتصال اختصاصی هماهنگی با قفل: این توابع از حلقه رویداد با asyncio.to_thread صدا زده می‌شوند چون ممکن است تا ۳۰ ثانیه منتظر قفل دیتابیس بمانند
+_cluster_db, _cluster_lock = None, threading.RLock()
+def _cluster_conn():
+    global _cluster_db
+    if _cluster_db is None:
+        get_settings_store()
+        conn = sqlite3.connect(SETTINGS_DB_FILE, isolation_level=None, check_same_thread=False, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS job_runs (job TEXT NOT NULL, slot TEXT NOT NULL, worker INTEGER NOT NULL, claimed_at REAL NOT NULL, PRIMARY KEY (job, slot))")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS price_snapshot (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL, fetched_at REAL NOT NULL, recorded INTEGER NOT NULL, prices TEXT NOT NULL)")
+        _cluster_db = conn
+    return _cluster_db
+def owns_chat(chat_id):
+    # هر کاربر (یا چت بدون فرستنده) فقط به یک کارگر تعلق دارد؛ مسیریاب وب‌هوک هم با همین قاعده به‌روزرسانی‌ها را پخش می‌کند
+    return WORKER_COUNT == 1 or int(chat_id) % WORKER_COUNT == WORKER_INDEX
+def claim_job_slot(job, slot):
+    # فقط اولین پردازه‌ای که یک نوبت را ادعا کند آن را اجرا می‌کند
+    with _cluster_lock:
+        cursor = _cluster_conn().execute("INSERT OR IGNORE INTO job_runs (job, slot, worker, claimed_at) VALUES (?, ?, ?, ?)", (job, slot, WORKER_INDEX, time.time()))
+        return cursor.rowcount == 1
+def last_claimed_slot(job):
+    with _cluster_lock: return _cluster_conn().execute("SELECT MAX(slot) FROM job_runs WHERE job = ?", (job,)).fetchone()[0]
+def prune_job_runs(before):
+    with _cluster_lock: return _cluster_conn().execute("DELETE FROM job_runs WHERE claimed_at < ?", (before,)).rowcount
+_lease_owner = f"{os.getpid()}-{random.getrandbits(32):08x}"
+def try_acquire_lease(name, ttl):
+    now = time.time()
+    with _cluster_lock:
+        cursor = _cluster_conn().execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.owner = excluded.owner OR leases.expires_at < ?", (name, _lease_owner, now + ttl, now))
+        return cursor.rowcount == 1
+def release_lease(name):
+    with _cluster_lock: _cluster_conn().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, _lease_owner))
+def publish_shared_snapshot(version, fetched_at, prices, recorded):
+    # نسخه‌ها بین پردازه‌ها یکتا می‌مانند تا کش‌های وابسته به نسخه در همه کارگرها معنای یکسان داشته باشند
+    with _cluster_lock:
+        conn = _cluster_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT version FROM price_snapshot WHERE id = 1").fetchone()
+            version = max(version, row[0] + 1 if row else 1)
+            conn.execute("INSERT OR REPLACE INTO price_snapshot (id, version, fetched_at, recorded, prices) VALUES (1, ?, ?, ?, ?)",
+                         (version, fetched_at, int(bool(recorded)), json.dumps(prices, ensure_ascii=False)))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return version
+def load_shared_snapshot(newer_than):
+    # خروجی: (اسنپ‌شات، آیا در تاریخچه ثبت شده) یا None اگر نسخه مشترک جدیدتر از newer_than نباشد
+    with _cluster_lock: row = _cluster_conn().execute("SELECT version, fetched_at, recorded, prices FROM price_snapshot WHERE id = 1 AND version > ?", (newer_than,)).fetchone()
+    if row is None: return None
+    return {'version': row[0], 'fetched_at': row[1], 'prices': json.loads(row[3])}, bool(row[2])
+
+# --- کلاینت HTTP ناهمگام با استخر اتصال، تلاش مجدد و قطع‌کننده مدار ---
+class CircuitBreaker:
+    # پس از چند شکست پیاپی باز می‌شود و تا پایان reset_timeout درخواست‌ها را فوراً رد می‌کند؛ سپس یک تلاش آزمایشی مجاز است
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold, self.reset_timeout = failure_threshold, reset_timeout
+        self.failures, self.opened_at, self.trial_in_flight = 0, None, False
+    @property
+    def state(self):
+        if self.opened_at is None: return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+    def allow(self):
+        state = self.state
+        if state == "closed": return True
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+    def record_success(self):
+        self.failures, self.opened_at, self.trial_in_flight = 0, None, False
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold: self.opened_at = time.monotonic()
+
+_http_client = None
+def get_http_client():
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            headers={'User-Agent': 'Mozilla/5.0 (compatible; MyGoldBot/4.4)'}, timeout=FETCH_ATTEMPT_TIMEOUT,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60))
+    return _http_client
+async def close_http_client(application=None):
+    global _http_client
+    if _http_client is not None: await _http_client.aclose()
+    _http_client = None
+def parse_brsapi_payload(raw_data):
+    prices = {}
+    for category in ['gold', 'currency', 'cryptocurrency']:
+        for item in raw_data.get(category, []): prices[item['symbol']] = item
+    return prices
+def add_derived_prices(prices):
+    # آیتم‌های مشتق‌شده روی داده نهایی (پس از ادغام منابع) محاسبه می‌شوند
+    if 'IR_GOLD_18K' in prices:
+        geram_price = float(prices['IR_GOLD_18K']['price'])
+        prices['IR_GOLD_MESGHAL'] = {'price': geram_price * 4.6083}
+    return prices
+def process_raw_prices(raw_data):
+    return add_derived_prices(parse_brsapi_payload(raw_data))
+PROVIDER_FORMATS = {'brsapi': parse_brsapi_payload}
+def _is_retryable(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return True
+class PriceProvider:
+    # یک منبع قیمت با قطع‌کننده مدار و پنجره تأخیرهای موفق اخیر؛ parse خروجی منبع را به {symbol: item} تبدیل می‌کند
+    def __init__(self, name, url, params=None, parse=parse_brsapi_payload):
+        self.name, self.url, self.params, self.parse = name, url, params or {}, parse
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        self.latencies = collections.deque(maxlen=HEDGE_LATENCY_WINDOW)
+    def hedge_delay(self):
+        if len(self.latencies) < HEDGE_MIN_SAMPLES: return HEDGE_INITIAL_DELAY
+        ordered = sorted(self.latencies)
+        return min(max(ordered[int(HEDGE_PERCENTILE * (len(ordered) - 1))], HEDGE_MIN_DELAY), FETCH_ATTEMPT_TIMEOUT)
+    async def request(self, client):
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(client.get(self.url, params=self.params), FETCH_ATTEMPT_TIMEOUT)
+            response.raise_for_status()
+            prices = self.parse(response.json())
+        except Exception as e:
+            UPSTREAM_FETCH_LATENCY.observe(time.perf_counter() - started, self.name, 'error')
+            UPSTREAM_FETCH_ERRORS.inc(self.name, f"http_{e.response.status_code}" if isinstance(e, httpx.HTTPStatusError) else type(e).__name__)
+            raise
+        elapsed = time.perf_counter() - started
+        self.latencies.append(elapsed)
+        UPSTREAM_FETCH_LATENCY.observe(elapsed, self.name, 'success')
+        return prices
+    async def hedged_request(self, client):
+        # هر بار که تا صدک تأخیرهای اخیر پاسخ موفقی نرسد (حداکثر HEDGE_MAX_EXTRA بار) درخواست تازه‌ای کنار قبلی‌ها فرستاده می‌شود
+        # و اولین پاسخ موفق برنده است؛ شکست سریع یک درخواست باعث نمی‌شود منتظر درخواست کند باقی‌مانده بمانیم
+        first = asyncio.ensure_future(self.request(client))
+        pending, error, hedges = {first}, None, 0
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=self.hedge_delay() if hedges < HEDGE_MAX_EXTRA else None, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedges += 1
+                    HEDGED_REQUESTS.inc(self.name, 'sent')
+                    pending.add(asyncio.ensure_future(self.request(client)))
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first: HEDGED_REQUESTS.inc(self.name, 'won')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending: task.cancel()
+    async def fetch(self, client):
+        # خروجی: {symbol: item} یا None پس از شکست همه تلاش‌ها
+        if not self.breaker.allow():
+            UPSTREAM_FETCH_ERRORS.inc(self.name, "circuit_open")
+            return None
+        for attempt in range(FETCH_MAX_ATTEMPTS):
+            try:
+                prices = await self.hedged_request(client)
+                self.breaker.record_success()
+                return prices
+            except Exception as e:
+                error = e if str(e) else type(e).__name__
+                print(f"Error fetching prices from {self.name} (attempt {attempt + 1}/{FETCH_MAX_ATTEMPTS}): {error}")
+                if not _is_retryable(e) or attempt == FETCH_MAX_ATTEMPTS - 1: break
+                # Full jitter: انتظار تصادفی بین صفر و سقف نمایی
+                await asyncio.sleep(random.uniform(0, min(FETCH_BACKOFF_CAP, FETCH_BACKOFF_BASE * 2 ** attempt)))
+        self.breaker.record_failure()
+        return None
+_price_providers = None
+def get_price_providers():
+    global _price_providers
+    if _price_providers is None:
+        _price_providers = [PriceProvider("brsapi", BRSAPI_URL, {'key': BRSAPI_KEY})]
+        for config in json.loads(PRICE_PROVIDERS or "[]"):
+            _price_providers.append(PriceProvider(config['name'], config['url'], config.get('params'), PROVIDER_FORMATS[config.get('format', 'brsapi')]))
+    return _price_providers
+def merge_provider_prices(results):
+    # results: {نام منبع: {symbol: item}}؛ برای هر نماد میانه قیمت‌ها (یا قیمت تازه‌ترین time_unix) انتخاب می‌شود
+    # و منابعی که بیش از PRICE_OUTLIER_THRESHOLD از میانه فاصله دارند پرت علامت‌گذاری و از انتخاب کنار گذاشته می‌شوند
+    if len(results) == 1: return dict(next(iter(results.values())))
+    by_symbol, merged = {}, {}
+    for name, prices in results.items():
+        for symbol, item in prices.items(): by_symbol.setdefault(symbol, []).append((name, item))
+    for symbol, entries in by_symbol.items():
+        values = []
+        for name, item in entries:
+            try: values.append((name, item, float(item['price'])))
+            except (KeyError, TypeError, ValueError): pass
+        if len(values) < 2:
+            merged[symbol] = values[0][1] if values else entries[0][1]
+            continue
+        median = float(np.median([price for _, _, price in values]))
+        # با دو مقدار نمی‌توان گفت کدام پرت است، پس علامت‌گذاری از سه منبع به بعد انجام می‌شود
+        outliers = [name for name, _, price in values if len(values) >= 3 and median and abs(price - median) / abs(median) > PRICE_OUTLIER_THRESHOLD]
+        agreeing = [entry for entry in values if entry[0] not in outliers] or values
+        freshest = max(agreeing, key=lambda entry: float(entry[1].get('time_unix') or 0))
+        price = float(np.median([price for _, _, price in agreeing])) if PRICE_MERGE_MODE == 'median' else freshest[2]
+        merged[symbol] = dict(freshest[1], price=price, sources=len(values))
+        if outliers:
+            merged[symbol]['outliers'] = outliers
+            for name in outliers: PRICE_OUTLIERS.inc(name)
+    return merged
+_background_fetches = set()
+async def get_and_process_prices():
+    # همه منابع هم‌زمان پرسیده می‌شوند؛ با رسیدن پاسخ اکثریت منابع یا حداکثر PRICE_MERGE_GRACE پس از اولین پاسخ موفق ادغام انجام می‌شود
+    # منابع کندتر در پس‌زمینه تمام می‌شوند تا آمار تأخیر و قطع‌کننده مدارشان به‌روز بماند، ولی در این اسنپ‌شات شرکت نمی‌کنند
+    client = get_http_client()
+    tasks = {asyncio.ensure_future(provider.fetch(client)): provider for provider in get_price_providers()}
+    results, pending, deadline, quorum = {}, set(tasks), None, len(tasks) // 2 + 1
+    while pending and len(results) < quorum:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not done: break
+        for task in done:
+            if task.result(): results[tasks[task].name] = task.result()
+        if results and deadline is None: deadline = time.monotonic() + PRICE_MERGE_GRACE
+    for task in pending:
+        _background_fetches.add(task)
+        task.add_done_callback(_background_fetches.discard)
+    if not results:
+        print("Error in get_and_process_prices: no price provider returned data.")
+        return None
+    return add_derived_prices(merge_provider_prices(results))
+
+# --- کش سراسری قیمت‌ها: یک درخواست در حال اجرا برای همه، سرو داده کهنه هنگام خطای API ---
+_price_snapshot = None
+_price_refresh_task = None
+async def _adopt_shared_snapshot(fresh_after):
+    # اسنپ‌شاتی که پردازه دیگری دریافت کرده پذیرفته می‌شود؛ تاریخچه را همان پردازه نوشته و اینجا فقط کش‌های خواندن تازه می‌شوند
+    global _price_snapshot
+    shared = await asyncio.to_thread(load_shared_snapshot, _price_snapshot['version'] if _price_snapshot else 0)
+    if shared and (_price_snapshot is None or shared[0]['version'] > _price_snapshot['version']):
+        snapshot, recorded = shared
+        _price_snapshot = snapshot
+        if _price_history is not None: _price_history.invalidate()
+        if recorded and _bubble_analytics is not None: _bubble_analytics.append(snapshot['fetched_at'], snapshot['prices'])
+        evaluate_alerts(snapshot['prices'])
+    return _price_snapshot is not None and _price_snapshot['fetched_at'] >= fresh_after
+async def _wait_for_fetch_turn(fresh_after):
+    # خروجی True یعنی این پردازه باید خودش از BrsApi دریافت کند؛ False یعنی اسنپ‌شات تازه پردازه دیگری پذیرفته شد
+    lease_ttl = FETCH_MAX_ATTEMPTS * (FETCH_ATTEMPT_TIMEOUT + FETCH_BACKOFF_CAP)
+    deadline = time.monotonic() + lease_ttl
+    while time.monotonic() < deadline:
+        if await _adopt_shared_snapshot(fresh_after): return False
+        if await asyncio.to_thread(try_acquire_lease, 'price_fetch', lease_ttl):
+            if not await _adopt_shared_snapshot(fresh_after): return True
+            await asyncio.to_thread(release_lease, 'price_fetch')
+            return False
+        await asyncio.sleep(CLUSTER_POLL_INTERVAL)
+    return True
+async def _refresh_price_snapshot(fresh_after):
+    global _price_snapshot
+    if WORKER_COUNT > 1 and not await _wait_for_fetch_turn(fresh_after): return _price_snapshot
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=15)
-        response.raise_for_status()
-        raw_data = response.json()
-        processed_prices = {}
-        for category in ['gold', 'currency', 'cryptocurrency']:
-            for item in raw_data.get(category, []): processed_prices[item['symbol']] = item
-        if 'IR_GOLD_18K' in processed_prices:
-            geram_price = float(processed_prices['IR_GOLD_18K']['price'])
-            processed_prices['IR_GOLD_MESGHAL'] = {'price': geram_price * 4.6083}
-        return processed_prices
+        prices = await get_and_process_prices()
     except Exception as e:
-        print(f"Error in get_and_process_prices: {e}")
-        return None
-def format_change(current_price, hourly_price):
-    if not hourly_price or hourly_price == 0: return ""
-    change = current_price - hourly_price
-    percent_change = (change / hourly_price) * 100
+        print(f"Error refreshing price snapshot: {e}")
+        prices = None
+    if prices:
+        fetched_at, written = time.time(), 0
+        try:
+            written = await asyncio.to_thread(get_price_history().append, fetched_at, {symbol: item['price'] for symbol, item in prices.items() if 'price' in item})
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Failed to append price history: {e}")
+        version = _price_snapshot['version'] + 1 if _price_snapshot else 1
+        if WORKER_COUNT > 1: version = await asyncio.to_thread(publish_shared_snapshot, version, fetched_at, prices, written)
+        _price_snapshot = {'version': version, 'fetched_at': fetched_at, 'prices': prices}
+        if written and _bubble_analytics is not None: _bubble_analytics.append(fetched_at, prices)
+        evaluate_alerts(prices)
+    if WORKER_COUNT > 1: await asyncio.to_thread(release_lease, 'price_fetch')
+    return _price_snapshot
+def _start_price_refresh(max_age=PRICE_CACHE_TTL):
+    # در حالت چندپردازه اسنپ‌شات مشترکی که از max_age ثانیه تازه‌تر باشد به جای دریافت دوباره پذیرفته می‌شود
+    global _price_refresh_task
+    if _price_refresh_task is None or _price_refresh_task.done():
+        fresh_after = time.time() - max_age
+        _price_refresh_task = asyncio.create_task(_refresh_price_snapshot(fresh_after))
+    return _price_refresh_task
+async def get_price_snapshot(force=False):
+    # خروجی: {'version', 'fetched_at', 'prices'} یا None اگر هیچ‌وقت داده‌ای دریافت نشده باشد
+    snapshot = _price_snapshot
+    age = time.time() - snapshot['fetched_at'] if snapshot else None
+    if snapshot and not force and age < PRICE_CACHE_TTL:
+        CACHE_REQUESTS.inc('price_snapshot', 'hit')
+        return snapshot
+    task = _start_price_refresh(0 if force else PRICE_CACHE_TTL)
+    if snapshot and not force and age < PRICE_CACHE_TTL + PRICE_CACHE_STALE:
+        CACHE_REQUESTS.inc('price_snapshot', 'stale')
+        return snapshot
+    CACHE_REQUESTS.inc('price_snapshot', 'miss')
+    return await asyncio.shield(task)
+def format_snapshot_age(snapshot):
+    age = int(time.time() - snapshot['fetched_at'])
+    if age < PRICE_CACHE_TTL + PRICE_CACHE_STALE: return ""
+    minutes = age // 60
+    age_text = f"{minutes} دقیقه" if minutes else f"{age} ثانیه"
+    return f"⚠️ <i>قیمت‌ها مربوط به {age_text} پیش است (سرور API پاسخگو نیست).</i>\n"
+def format_change(current_price, past_price, label=""):
+    if not past_price or past_price == 0: return ""
+    change = current_price - past_price
+    percent_change = (change / past_price) * 100
     emoji = "➖" if -0.1 < percent_change < 0.1 else "▲" if percent_change > 0 else "▼"
-    return f" ({emoji} {percent_change:+.2f}%)"
-def calculate_all_bubbles(prices):
+    return f"{label} {emoji} {percent_change:+.2f}%".strip()
+def format_changes(symbol, current_price, reference_prices):
+    parts = [format_change(current_price, reference_prices.get(period, {}).get(symbol), label) for period, label in CHANGE_PERIODS]
+    parts = [part for part in parts if part]
+    return f" ({' | '.join(parts)})" if parts else ""
+def calculate_all_bubbles(prices, quiet=False):
     bubbles = {}
     try:
         ounce_price, dollar_price = float(prices['XAUUSD']['price']), float(prices['USD']['price'])
         gram_price_global = (ounce_price * dollar_price) / 31.1035
-        items_to_calc = {'IR_COIN_EMAMI':(8.133,300000),'IR_COIN_BAHAR':(8.133,300000),'IR_COIN_HALF':(4.0665,150000),'IR_COIN_QUARTER':(2.03325,100000)}
-        for symbol, (weight, mint_cost) in items_to_calc.items():
+        for symbol, (factor, fixed) in BUBBLE_ITEMS.items():
             if symbol in prices:
-                market, intrinsic = float(prices[symbol]['price']), (gram_price_global*weight*0.900)+mint_cost
+                market, intrinsic = float(prices[symbol]['price']), gram_price_global*factor+fixed
                 bubbles[symbol] = {'market':market,'intrinsic':intrinsic,'percent':((market-intrinsic)/intrinsic)*100}
-        if 'IR_GOLD_18K' in prices:
-            market, intrinsic = float(prices['IR_GOLD_18K']['price']), gram_price_global*0.75
-            bubbles['IR_GOLD_18K'] = {'market':market,'intrinsic':intrinsic,'percent':((market-intrinsic)/intrinsic)*100}
-        if 'IR_GOLD_MESGHAL' in prices:
-            market, intrinsic = float(prices['IR_GOLD_MESGHAL']['price']), (gram_price_global*0.75)*4.6083
-            bubbles['IR_GOLD_MESGHAL'] = {'market':market,'intrinsic':intrinsic,'percent':((market-intrinsic)/intrinsic)*100}
         return bubbles
     except KeyError as e:
-        print(f"Base data for bubble calc missing: {e}")
+        if not quiet: print(f"Base data for bubble calc missing: {e}")
         return None
+_date_header_cache = (None, "")
 def get_persian_date_header():
+    global _date_header_cache
+    minute = int(time.time() // 60)
+    if _date_header_cache[0] != minute: _date_header_cache = (minute, _build_persian_date_header())
+    return _date_header_cache[1]
+def _build_persian_date_header():
     tehran_zone = pytz.timezone("Asia/Tehran")
     tehran_dt = datetime.now(tehran_zone)
     jdate = jdatetime.datetime.fromgregorian(datetime=tehran_dt)
@@ -135,47 +975,98 @@ def get_persian_date_header():
     return f"📆 {persian_days[jdate.weekday()]} {jdate.day} {persian_months[jdate.month-1]}    🕰 {jdate.strftime('%H:%M')}"
 
 # --- بخش ۳: توابع اصلی ربات ---
+@instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = [[KeyboardButton("💵 نرخ ارزها"), KeyboardButton("🪙 نرخ طلا و سکه")], [KeyboardButton("📈 ارزهای دیجیتال"), KeyboardButton("🫧 تحلیل حباب")], [KeyboardButton("⚙️ تنظیمات")]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_html("سلام! به ربات تحلیل‌گر شخصی شما خوش آمدید.", reply_markup=reply_markup)
 
+@instrument_handler
 async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_message = update.message.text
+    if context.user_data.get('pending_alert_target'):
+        if user_message not in REPORT_TYPES.values() and user_message != "⚙️ تنظیمات":
+            await receive_alert_threshold(update, context)
+            return
+        context.user_data.pop('pending_alert_target')
     if user_message == "⚙️ تنظیمات":
         await show_settings_main_menu(update)
         return
-    await update.message.reply_text("در حال دریافت قیمت‌های لحظه‌ای و مقایسه...")
-    live_prices = get_and_process_prices(BRSAPI_KEY)
-    if not live_prices:
+    snapshot = await get_price_snapshot()
+    if not snapshot:
         await update.message.reply_text("❌ <b>خطای دریافت قیمت لحظه‌ای</b>. سرور API پاسخگو نیست.", parse_mode=ParseMode.HTML)
         return
-    date_header = get_persian_date_header()
-    message_text = "لطفاً از دکمه‌های منو استفاده کنید."
+    date_header = get_persian_date_header() + "\n" + format_snapshot_age(snapshot)
+    message_text, reply_markup = "لطفاً از دکمه‌های منو استفاده کنید.", None
     if user_message == "🫧 تحلیل حباب":
-        message_text = build_bubble_report(live_prices)
+        message_text = render_report('bubble', None, snapshot)
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("📈 نمودار حباب ۳۰ روزه", callback_data="chart:BUBBLE:30d")]])
     elif user_message in ["💵 نرخ ارزها", "🪙 نرخ طلا و سکه", "📈 ارزهای دیجیتال"]:
         user_prefs = get_user_prefs(update.effective_user.id)
         category = "currency" if user_message == "💵 نرخ ارزها" else "gold" if user_message == "🪙 نرخ طلا و سکه" else "crypto"
-        message_text = build_single_report(category, user_prefs, live_prices, read_hourly_prices())
-    await update.message.reply_text(text=f"{date_header}\n\n{message_text}", parse_mode=ParseMode.HTML)
+        message_text = render_report(category, user_prefs, snapshot)
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔴 نمایش زنده", callback_data=f"ticker_start_{category}")]])
+    await update.message.reply_text(text=f"{date_header}\n{message_text}", parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+@instrument_handler
+async def bubble_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    window_days = BUBBLE_ROLLING_DAYS
+    if context.args:
+        try: window_days = max(1, int(context.args[0]))
+        except ValueError:
+            await update.message.reply_text("استفاده: /bubble_history [تعداد روز]")
+            return
+    started = time.perf_counter()
+    analytics = get_bubble_analytics()
+    lines, points, since = [f"🫧 <b>تاریخچه حباب</b> (پنجره {window_days} روزه)\n"], 0, time.time()
+    for symbol in BUBBLE_ITEMS:
+        stats = analytics.stats(symbol, window_days)
+        if not stats: continue
+        points, since = max(points, stats['points']), min(since, stats['since'])
+        info = FULL_SYMBOL_LIST['gold'].get(symbol, {})
+        lines.append(f"&#x200f;{info.get('emoji', '▫️')} <b>{info.get('name', symbol)}:</b> <code>{stats['current']:+.2f}%</code>\n"
+                     f"میانگین <code>{stats['rolling_mean']:+.2f}%</code> | صدک <code>{stats['percentile_rank']:.0f}</code> | "
+                     f"<code>{stats['z_score']:+.2f}σ</code> | کمینه/بیشینه <code>{stats['min']:+.2f}%</code> / <code>{stats['max']:+.2f}%</code>\n")
+    if len(lines) == 1:
+        await update.message.reply_text("❌ هنوز تاریخچه‌ای برای تحلیل حباب ثبت نشده است.")
+        return
+    since_date = jdatetime.date.fromgregorian(date=datetime.fromtimestamp(since, pytz.timezone("Asia/Tehran")).date())
+    lines.append(f"<i>⏱ {(time.perf_counter() - started) * 1000:.1f}ms روی {points:,} نقطه از {since_date.strftime('%Y/%m/%d')}</i>")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
 # --- توابع ساخت گزارش ---
-def build_single_report(category, user_prefs, live_prices, hourly_prices):
+# کش قطعات گزارش با کلید (نسخه اسنپ‌شات، نوع گزارش، تاپل آیتم‌های کاربر)؛ با رسیدن نسخه جدید کامل خالی می‌شود
+REPORT_CACHE_MAX_ENTRIES = 5000
+_report_cache, _report_cache_version = {}, None
+def render_report(report_type, user_prefs, snapshot):
+    global _report_cache, _report_cache_version
+    if snapshot['version'] != _report_cache_version or len(_report_cache) >= REPORT_CACHE_MAX_ENTRIES:
+        _report_cache, _report_cache_version = {}, snapshot['version']
+    prefs_key = () if report_type == 'bubble' else tuple(dict.fromkeys(user_prefs.get(report_type, [])))
+    cache_key = (snapshot['version'], report_type, prefs_key)
+    fragment = _report_cache.get(cache_key)
+    CACHE_REQUESTS.inc('report_fragment', 'miss' if fragment is None else 'hit')
+    if fragment is None:
+        if report_type == 'bubble': fragment = build_bubble_report(snapshot['prices'])
+        else: fragment = build_single_report(report_type, {report_type: list(prefs_key)}, snapshot['prices'], get_reference_prices(snapshot))
+        _report_cache[cache_key] = fragment
+    return fragment
+def build_single_report(category, user_prefs, live_prices, reference_prices):
     title_emoji = "💵" if category == "currency" else "🪙" if category == "gold" else "📈"
     title = f"{title_emoji} <b>نرخ لحظه‌ای {category.title()}</b>\n\n"
     report_text, found_items = title, 0
     for symbol in user_prefs.get(category, []):
         if symbol in live_prices:
             found_items += 1
-            price, hourly_price = float(live_prices[symbol]['price']), float(hourly_prices.get(symbol, {}).get('price', 0))
+            price = float(live_prices[symbol]['price'])
+            changes = format_changes(symbol, price, reference_prices)
             symbol_info = FULL_SYMBOL_LIST.get(category, {}).get(symbol, {})
             emoji, display_name = symbol_info.get('emoji', '▫️'), symbol_info.get('name', symbol)
             if category == 'crypto':
                 price_format = ",.8f" if price < 0.01 else ",.2f"
-                report_text += f"&#x200f;{emoji} <b>{display_name}</b> ({symbol})\n<code>${price:{price_format}}</code>{format_change(price, hourly_price)}\n\n"
+                report_text += f"&#x200f;{emoji} <b>{display_name}</b> ({symbol})\n<code>${price:{price_format}}</code>{changes}\n\n"
             else:
-                report_text += f"&#x200f;{emoji} <b>{display_name}:</b> <code>{int(price):,} تومان</code>{format_change(price, hourly_price)}\n"
+                report_text += f"&#x200f;{emoji} <b>{display_name}:</b> <code>{int(price):,} تومان</code>{changes}\n"
     if found_items == 0:
         return "موردی برای نمایش انتخاب نشده است. لطفاً از منوی «تنظیمات»، آیتم‌های دلخواه خود را برای این بخش فعال کنید."
     return report_text
@@ -203,17 +1094,24 @@ def build_bubble_report(live_prices):
     elif 3 <= coin_bubble_percent <= 7: strategy_text = "حباب سکه در <b>محدوده تعادل</b> است. استراتژی منطقی **نگهداری دارایی** است."
     elif 7 < coin_bubble_percent <= 15: strategy_text = "حباب سکه در <b>محدوده بالا (منطقه احتیاط)</b> قرار دارد. **فروش پله‌ای سکه** منطقی به نظر می‌رسد."
     else: strategy_text = "حباب سکه در <b>محدوده بسیار بالا (منطقه ریسک)</b> است. **تبدیل سکه به طلای آب‌شده** توصیه می‌شود."
+    history_text = describe_bubble_history(get_bubble_analytics().stats('IR_COIN_EMAMI'))
+    if history_text: strategy_text += "\n" + history_text
     analysis_text = f"\n----------------------------------------\n💡 <b>تحلیل استراتژیک:</b>\n{strategy_text}\n\n⚠️ <b>سلب مسئولیت:</b>\n<i>این تحلیل یک پیشنهاد مالی نیست.</i>"
     return market_prices_text + intrinsic_prices_text + analysis_text
 
 # --- توابع مدیریت منوها ---
 async def show_settings_main_menu(update_or_query):
-    keyboard = [[InlineKeyboardButton("💵 تنظیمات ارزها", callback_data='settings_currency')], [InlineKeyboardButton("🪙 تنظیمات طلا و سکه", callback_data='settings_gold')], [InlineKeyboardButton("📈 تنظیمات رمزارزها", callback_data='settings_crypto')], [InlineKeyboardButton("⏰ زمان‌بندی پیام خودکار", callback_data='settings_schedule')], [InlineKeyboardButton("❌ بستن", callback_data='close_settings')]]
+    keyboard = [[InlineKeyboardButton("💵 تنظیمات ارزها", callback_data='settings_currency')], [InlineKeyboardButton("🪙 تنظیمات طلا و سکه", callback_data='settings_gold')], [InlineKeyboardButton("📈 تنظیمات رمزارزها", callback_data='settings_crypto')], [InlineKeyboardButton("⏰ زمان‌بندی پیام خودکار", callback_data='settings_schedule')], [InlineKeyboardButton("🔔 هشدارهای قیمت", callback_data='alerts_menu')], [InlineKeyboardButton("❌ بستن", callback_data='close_settings')]]
     message_text = "منوی تنظیمات:"
     if isinstance(update_or_query, Update):
         await update_or_query.message.reply_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
     else:
         await update_or_query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
+async def safe_edit_message(edit, *args, **kwargs):
+    # ویرایش با متن تکراری برای تلگرام خطاست؛ این حالت را بی‌صدا نادیده می‌گیریم و بقیه خطاها را بالا می‌فرستیم
+    try: return await edit(*args, **kwargs)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e): raise
 async def show_item_selection_menu(query, callback_data):
     category = callback_data.split('_')[1]
     user_prefs = get_user_prefs(query.from_user.id)
@@ -231,19 +1129,13 @@ async def show_item_selection_menu(query, callback_data):
             row = []
     if row: keyboard.append(row)
     keyboard.append([InlineKeyboardButton("🔙 بازگشت به تنظیمات", callback_data='settings_main')])
-    try:
-        await query.edit_message_text(f"موارد مورد نظر برای نمایش در بخش <b>{category.replace('_', ' ').title()}</b> را انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
-    except BadRequest as e:
-        if "Message is not modified" not in str(e): raise
+    await safe_edit_message(query.edit_message_text, f"موارد مورد نظر برای نمایش در بخش <b>{category.replace('_', ' ').title()}</b> را انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+def _toggle_member(items, item):
+    if item in items: items.remove(item)
+    else: items.append(item)
 async def toggle_display_item(query, callback_data):
     _, category, symbol = callback_data.split('_', 2)
-    user_id = query.from_user.id
-    get_user_prefs(user_id)
-    all_settings = load_user_settings()
-    pref_list = all_settings[str(user_id)].get(category, [])
-    if symbol in pref_list: pref_list.remove(symbol)
-    else: pref_list.append(symbol)
-    save_user_settings(all_settings)
+    await update_user_prefs(query.from_user.id, lambda prefs: _toggle_member(prefs.setdefault(category, []), symbol))
     await show_item_selection_menu(query, f"settings_{category}")
 async def show_schedule_menu(query):
     user_prefs = get_user_prefs(query.from_user.id)
@@ -281,31 +1173,21 @@ async def show_time_selection_menu(query):
 async def toggle_schedule_time(query, callback_data):
     time_str = callback_data.split('_')[-1]
     user_id = query.from_user.id
-    get_user_prefs(user_id)
-    all_settings = load_user_settings()
-    time_list = all_settings[str(user_id)]['schedule']['times']
-    if time_str in time_list: time_list.remove(time_str)
-    else: time_list.append(time_str)
-    save_user_settings(all_settings)
+    prefs = await update_user_prefs(user_id, lambda prefs: _toggle_member(prefs['schedule']['times'], time_str))
+    reindex_user_schedule(user_id, prefs)
     await show_time_selection_menu(query)
 async def toggle_schedule_report(query, callback_data):
     report_key = callback_data.split('_')[-1]
-    user_id = query.from_user.id
-    get_user_prefs(user_id)
-    all_settings = load_user_settings()
-    report_list = all_settings[str(user_id)]['schedule']['reports']
-    if report_key in report_list: report_list.remove(report_key)
-    else: report_list.append(report_key)
-    save_user_settings(all_settings)
+    await update_user_prefs(query.from_user.id, lambda prefs: _toggle_member(prefs['schedule'].setdefault('reports', []), report_key))
     await show_schedule_menu(query)
 async def toggle_schedule_active(query):
     user_id = query.from_user.id
-    get_user_prefs(user_id)
-    all_settings = load_user_settings()
-    all_settings[str(user_id)]['schedule']['active'] = not all_settings[str(user_id)]['schedule'].get('active', False)
-    save_user_settings(all_settings)
+    def flip_active(prefs): prefs['schedule']['active'] = not prefs['schedule'].get('active', False)
+    prefs = await update_user_prefs(user_id, flip_active)
+    reindex_user_schedule(user_id, prefs)
     await show_schedule_menu(query)
 
+@instrument_handler
 async def settings_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -317,41 +1199,820 @@ async def settings_callback_handler(update: Update, context: ContextTypes.DEFAUL
     elif callback_data.startswith('schedule_toggle_time_'): await toggle_schedule_time(query, callback_data)
     elif callback_data.startswith('schedule_toggle_report_'): await toggle_schedule_report(query, callback_data)
     elif callback_data == 'schedule_toggle_active': await toggle_schedule_active(query)
+    elif callback_data.startswith('alert'): await alerts_callback_handler(query, callback_data, context)
+    elif callback_data.startswith('ticker_'): await ticker_callback_handler(query, callback_data, context)
+    elif callback_data.startswith('chart:'): await chart_callback_handler(query, callback_data, context)
     elif callback_data.startswith('toggle_'): await toggle_display_item(query, callback_data)
     elif callback_data.startswith('settings_'): await show_item_selection_menu(query, callback_data)
 
-async def send_aggregated_report(chat_id, report_types, context, live_prices=None):
-    if not live_prices: live_prices = get_and_process_prices(BRSAPI_KEY)
-    if not live_prices: return
-    user_prefs, hourly_prices = get_user_prefs(chat_id), read_hourly_prices()
-    final_report = f"🔔 <b>گزارش خودکار شما - {get_persian_date_header()}</b>\n"
+# --- محدودکننده نرخ ارسال (الگوریتم سطل توکن به شکل GCRA: هر درخواست زمان مجاز خود را رزرو می‌کند) ---
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.interval, self.tolerance, self.tat = 1.0 / rate, (capacity - 1) / rate, 0.0
+    def reserve(self, now):
+        # خروجی: چند ثانیه باید تا ارسال صبر کرد
+        tat = max(self.tat, now)
+        self.tat = tat + self.interval
+        return max(0.0, tat - self.tolerance - now)
+class RateLimiter:
+    def __init__(self, global_rate, per_chat_interval):
+        self.global_bucket, self.per_chat_interval, self.chat_next_send = TokenBucket(global_rate, max(1, int(global_rate))), per_chat_interval, {}
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        chat_at = max(now, self.chat_next_send.get(chat_id, 0.0))
+        self.chat_next_send[chat_id] = chat_at + self.per_chat_interval
+        if len(self.chat_next_send) > 100000:
+            self.chat_next_send = {cid: t for cid, t in self.chat_next_send.items() if t > now}
+        # ابتدا تا نوبت چت صبر می‌کنیم و سپس از سطل سراسری رزرو می‌گیریم تا چت‌های منتظر سهم دیگران را نگیرند
+        if chat_at > now: await asyncio.sleep(chat_at - now)
+        delay = self.global_bucket.reserve(time.monotonic())
+        if delay: await asyncio.sleep(delay)
+telegram_rate_limiter = RateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_INTERVAL)
+async def send_rate_limited(bot, chat_id, kind="scheduled", method="send_message", **kwargs):
+    send = getattr(bot, method)
+    await telegram_rate_limiter.acquire(chat_id)
+    try:
+        message = await send(chat_id=chat_id, **kwargs)
+    except RetryAfter as e:
+        TELEGRAM_SEND_FAILURES.inc(type(e).__name__)
+        retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+        await asyncio.sleep(retry_after)
+        await telegram_rate_limiter.acquire(chat_id)
+        try: message = await send(chat_id=chat_id, **kwargs)
+        except Exception as retry_error:
+            TELEGRAM_SEND_FAILURES.inc(type(retry_error).__name__)
+            raise
+    except Exception as e:
+        TELEGRAM_SEND_FAILURES.inc(type(e).__name__)
+        raise
+    MESSAGES_SENT.inc(kind)
+    return message
+
+async def send_aggregated_report(chat_id, report_types, context, snapshot=None, user_prefs=None):
+    if not snapshot: snapshot = await get_price_snapshot()
+    if not snapshot: return
+    if user_prefs is None: user_prefs = get_user_prefs(chat_id)
+    final_report = f"🔔 <b>گزارش خودکار شما - {get_persian_date_header()}</b>\n" + format_snapshot_age(snapshot)
     final_report += "====================\n"
     for report_type in sorted(report_types, key=lambda x: list(REPORT_TYPES.keys()).index(x)):
-        if report_type == 'bubble': final_report += build_bubble_report(live_prices) + "\n\n"
-        else: final_report += build_single_report(report_type, user_prefs, live_prices, hourly_prices) + "\n"
-    await context.bot.send_message(chat_id=chat_id, text=final_report, parse_mode=ParseMode.HTML)
-async def auto_message_scheduler(context: ContextTypes.DEFAULT_TYPE):
-    current_time = datetime.now(pytz.timezone("Asia/Tehran")).strftime("%H:%M")
+        final_report += render_report(report_type, user_prefs, snapshot) + ("\n\n" if report_type == 'bubble' else "\n")
+    await send_rate_limited(context.bot, chat_id, text=final_report, parse_mode=ParseMode.HTML)
+
+# --- نمایه زمان‌بندی: نگاشت ساعت HH:MM به شناسه چت‌های مشترک فعال ---
+_schedule_index = None
+_schedule_user_slots = {}
+_last_scheduler_minute = None
+def _get_schedule_index():
+    global _schedule_index
+    if _schedule_index is None:
+        _schedule_index = {}
+        for user_id, prefs in load_user_settings().items(): reindex_user_schedule(user_id, prefs)
+    return _schedule_index
+def reindex_user_schedule(user_id, prefs):
+    if _schedule_index is None or not owns_chat(user_id): return
+    user_id_str = str(user_id)
+    for slot in _schedule_user_slots.pop(user_id_str, ()):
+        _schedule_index[slot].discard(user_id_str)
+    schedule_info = prefs.get("schedule", {})
+    if not schedule_info.get("active"): return
+    slots = set(schedule_info.get("times", []))
+    for slot in slots: _schedule_index.setdefault(slot, set()).add(user_id_str)
+    if slots: _schedule_user_slots[user_id_str] = slots
+async def deliver_slot(slot, context, slot_time=None):
+    chat_ids = list(_get_schedule_index().get(slot, ()))
+    if not chat_ids: return
+    if slot_time is None: slot_time = time.time()
+    snapshot = await get_price_snapshot()
+    if not snapshot:
+        print(f"Skipping scheduled slot {slot}: no price snapshot available.")
+        return
     all_settings = load_user_settings()
-    for user_id, prefs in all_settings.items():
-        schedule_info = prefs.get("schedule", {})
-        if schedule_info.get("active") and current_time in schedule_info.get("times", []):
-            report_types = schedule_info.get("reports", [])
-            if report_types:
-                print(f"Sending scheduled report to {user_id} at {current_time}")
-                try:
-                    await send_aggregated_report(user_id, report_types, context)
-                except Exception as e:
-                    print(f"Failed to send scheduled message to {user_id}: {e}")
+    print(f"Sending scheduled reports for slot {slot} to {len(chat_ids)} chats")
+    pending = iter(chat_ids)
+    async def worker():
+        for user_id in pending:
+            prefs = all_settings.get(user_id, {})
+            report_types = prefs.get("schedule", {}).get("reports", [])
+            if not report_types: continue
+            try:
+                await send_aggregated_report(user_id, report_types, context, snapshot, prefs)
+                SCHEDULER_LAG.observe(time.time() - slot_time)
+            except Exception as e:
+                print(f"Failed to send scheduled message to {user_id}: {e}")
+    await asyncio.gather(*(worker() for _ in range(min(SCHEDULER_CONCURRENCY, len(chat_ids)))))
+async def auto_message_scheduler(context: ContextTypes.DEFAULT_TYPE):
+    global _last_scheduler_minute
+    now_minute = datetime.now(pytz.timezone("Asia/Tehran")).replace(second=0, microsecond=0)
+    # اگر اجرای قبلی دیر تمام شده یا تیک‌هایی از دست رفته باشد، دقیقه‌های جاافتاده هم ارسال می‌شوند
+    # در حالت چندپردازه هر کارگر فقط چت‌های سهم خودش را می‌فرستد و هر دقیقه را پس از ارسال ثبت می‌کند؛ پس از راه‌اندازی مجدد
+    # از آخرین دقیقه ثبت‌شده ادامه می‌دهد، پس دقیقه‌ای که وسط ارسالش کارگر از کار افتاده دوباره ارسال می‌شود (حداقل یک بار)
+    job = f"schedule:{WORKER_INDEX}/{WORKER_COUNT}"
+    if _last_scheduler_minute is None and WORKER_COUNT > 1 and (last_slot := await asyncio.to_thread(last_claimed_slot, job)):
+        _last_scheduler_minute = pytz.timezone("Asia/Tehran").localize(datetime.strptime(last_slot, "%Y-%m-%d %H:%M"))
+    first_minute = now_minute
+    if _last_scheduler_minute is not None:
+        first_minute = max(_last_scheduler_minute + timedelta(minutes=1), now_minute - timedelta(minutes=SCHEDULER_MAX_CATCHUP_MINUTES))
+    _last_scheduler_minute = now_minute
+    minute = first_minute
+    while minute <= now_minute:
+        await deliver_slot(minute.strftime("%H:%M"), context, minute.timestamp())
+        if WORKER_COUNT > 1: await asyncio.to_thread(claim_job_slot, job, minute.strftime("%Y-%m-%d %H:%M"))
+        minute += timedelta(minutes=1)
 
-def main() -> None:
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+# --- هشدارهای قیمت و حباب: نمایه آستانه‌های مرتب برای هر (هدف، جهت) ---
+class AlertEngine:
+    # کلیدها طوری مرتب شده‌اند که هشدارهای فعال‌شده همیشه در انتهای لیست باشند:
+    # 'above' با کلید -threshold (فعال وقتی value > threshold) و 'below' با کلید threshold (فعال وقتی value < threshold)
+    # بنابراین هزینه بررسی هر هدف O(log n + k) است و حذف k هشدار فعال‌شده از انتهای لیست انجام می‌شود
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute("CREATE TABLE IF NOT EXISTS alerts (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, target TEXT NOT NULL, direction TEXT NOT NULL, threshold REAL NOT NULL, created_at REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS alerts_user ON alerts (user_id)")
+        self.alerts, self.user_alerts, self.index, self.pending_deletes = {}, {}, {}, []
+        self._write_conn, self._write_lock = None, threading.Lock()
+        grouped = {}
+        for alert_id, user_id, target, direction, threshold in self.conn.execute("SELECT id, user_id, target, direction, threshold FROM alerts"):
+            if not owns_chat(user_id): continue
+            self.alerts[alert_id] = (user_id, target, direction, threshold)
+            self.user_alerts.setdefault(user_id, set()).add(alert_id)
+            grouped.setdefault((target, direction), []).append((self._key(direction, threshold), alert_id))
+        for group, entries in grouped.items():
+            entries.sort()
+            self.index[group] = ([key for key, _ in entries], [alert_id for _, alert_id in entries])
+    @staticmethod
+    def _key(direction, threshold):
+        return -threshold if direction == 'above' else threshold
+    def _write(self, sql, params):
+        # نوشتن‌ها از نخ‌های جدا (asyncio.to_thread) با اتصال اختصاصی انجام می‌شوند تا حلقه رویداد منتظر قفل دیتابیس نماند
+        with self._write_lock:
+            if self._write_conn is None:
+                path = self.conn.execute("PRAGMA database_list").fetchone()[2]
+                self._write_conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+            return self._write_conn.execute(sql, params).lastrowid
+    def insert(self, user_id, target, direction, threshold):
+        return self._write("INSERT INTO alerts (user_id, target, direction, threshold, created_at) VALUES (?, ?, ?, ?, ?)", (str(user_id), target, direction, threshold, time.time()))
+    def add(self, user_id, target, direction, threshold):
+        return self.index_alert(self.insert(user_id, target, direction, threshold), user_id, target, direction, threshold)
+    def index_alert(self, alert_id, user_id, target, direction, threshold):
+        # فقط نمایه درون‌حافظه؛ روی حلقه رویداد اجرا می‌شود تا با evaluate هم‌زمان نشود
+        user_id = str(user_id)
+        self.alerts[alert_id] = (user_id, target, direction, threshold)
+        self.user_alerts.setdefault(user_id, set()).add(alert_id)
+        keys, ids = self.index.setdefault((target, direction), ([], []))
+        position = bisect.bisect_right(keys, self._key(direction, threshold))
+        keys.insert(position, self._key(direction, threshold))
+        ids.insert(position, alert_id)
+        return alert_id
+    def remove(self, alert_id, user_id):
+        # ورودی نمایه همین‌جا روی حلقه رویداد حذف می‌شود؛ ردیف دیتابیس را فراخواننده با delete_alerts حذف می‌کند
+        alert = self.alerts.get(alert_id)
+        if not alert or alert[0] != str(user_id): return False
+        del self.alerts[alert_id]
+        self.user_alerts.get(alert[0], set()).discard(alert_id)
+        _, target, direction, threshold = alert
+        group = self.index.get((target, direction))
+        if group:
+            keys, ids = group
+            key = self._key(direction, threshold)
+            # هشدارهای هم‌آستانه کنار هم‌اند؛ فقط همان بازه برای یافتن alert_id پیمایش می‌شود
+            for position in range(bisect.bisect_left(keys, key), bisect.bisect_right(keys, key)):
+                if ids[position] == alert_id:
+                    del keys[position], ids[position]
+                    break
+        return True
+    def list_for_user(self, user_id):
+        return sorted((alert_id, self.alerts[alert_id]) for alert_id in self.user_alerts.get(str(user_id), ()))
+    def evaluate(self, values):
+        # values: {target: مقدار فعلی}؛ خروجی: [(alert_id, user_id, target, direction, threshold, value)]
+        # حذف از دیتابیس به delete_alerts سپرده می‌شود تا بررسی اسنپ‌شات حلقه رویداد را معطل نکند
+        triggered = []
+        for target, value in values.items():
+            for direction in ('above', 'below'):
+                group = self.index.get((target, direction))
+                if not group or not group[0]: continue
+                keys, ids = group
+                # مقایسه اکید: هشداری که دقیقاً روی مقدار فعلی ساخته شده بلافاصله فعال نمی‌شود
+                start = bisect.bisect_right(keys, self._key(direction, value))
+                if start == len(keys): continue
+                hit_ids = ids[start:]
+                del keys[start:], ids[start:]
+                for alert_id in hit_ids:
+                    alert = self.alerts.pop(alert_id, None)
+                    if alert is None: continue
+                    self.user_alerts.get(alert[0], set()).discard(alert_id)
+                    triggered.append((alert_id, *alert, value))
+                    self.pending_deletes.append(alert_id)
+        return triggered
+    def take_pending_deletes(self, limit=250):
+        batch, self.pending_deletes = self.pending_deletes[:limit], self.pending_deletes[limit:]
+        return batch
+    def delete_alerts(self, alert_ids):
+        # در نخ جداگانه اجرا می‌شود؛ دسته‌های کوچک قفل نوشتن را کوتاه نگه می‌دارند
+        self._write(f"DELETE FROM alerts WHERE id IN ({','.join('?' * len(alert_ids))})", alert_ids)
+
+_alert_engine = None
+_alert_queue = None
+def get_alert_engine():
+    global _alert_engine
+    if _alert_engine is None: _alert_engine = AlertEngine(get_settings_store().conn)
+    return _alert_engine
+def alert_values(prices):
+    values = {symbol: float(item['price']) for symbol, item in prices.items() if 'price' in item}
+    for symbol, data in (calculate_all_bubbles(prices, quiet=True) or {}).items(): values[f"BUBBLE_{symbol}"] = data['percent']
+    return values
+def describe_alert_target(target):
+    is_bubble = target.startswith("BUBBLE_")
+    symbol = target[len("BUBBLE_"):] if is_bubble else target
+    info = next((symbols[symbol] for symbols in FULL_SYMBOL_LIST.values() if symbol in symbols), {})
+    name = f"{info.get('emoji', '▫️')} {info.get('name', symbol)}"
+    return f"{name} (حباب)" if is_bubble else name
+def format_alert_value(target, value):
+    return f"{value:+.2f}%" if target.startswith("BUBBLE_") else f"{value:,.8g}" if value < 1 else f"{value:,.2f}" if value < 1000 else f"{int(value):,}"
+_alert_flush_task = None
+async def _flush_alert_deletes():
+    while batch := _alert_engine.take_pending_deletes():
+        try:
+            await asyncio.to_thread(_alert_engine.delete_alerts, batch)
+        except sqlite3.Error as e:
+            print(f"Failed to delete {len(batch)} triggered alerts: {e}")
+def evaluate_alerts(prices):
+    # روی هر اسنپ‌شات تازه اجرا می‌شود؛ ارسال‌ها در صف ارسال‌کننده محدودشده قرار می‌گیرند
+    global _alert_flush_task
+    if _alert_engine is None or _alert_queue is None: return
+    for hit in _alert_engine.evaluate(alert_values(prices)): _alert_queue.put_nowait(hit)
+    if _alert_engine.pending_deletes and (_alert_flush_task is None or _alert_flush_task.done()):
+        _alert_flush_task = asyncio.create_task(_flush_alert_deletes())
+async def _alert_dispatch_worker(bot):
+    while True:
+        alert_id, user_id, target, direction, threshold, value = await _alert_queue.get()
+        sign = ">" if direction == 'above' else "<"
+        text = f"🔔 <b>هشدار قیمت</b>\n&#x200f;{describe_alert_target(target)} به <code>{format_alert_value(target, value)}</code> رسید.\nشرط: {sign} <code>{format_alert_value(target, threshold)}</code>"
+        try:
+            await send_rate_limited(bot, user_id, kind="alert", text=text, parse_mode=ParseMode.HTML)
+        except Exception as e:
+            print(f"Failed to send alert {alert_id} to {user_id}: {e}")
+        finally:
+            _alert_queue.task_done()
+async def start_alert_dispatcher(application):
+    global _alert_queue
+    started = time.perf_counter()
+    engine = await asyncio.to_thread(get_alert_engine)
+    print(f"Loaded {len(engine.alerts)} price alerts in {time.perf_counter() - started:.2f}s.")
+    _alert_queue = asyncio.Queue()
+    for _ in range(ALERT_DISPATCH_WORKERS): asyncio.get_running_loop().create_task(_alert_dispatch_worker(application.bot))
+
+ALERT_PICK_GROUPS = {'currency': "💵 ارزها", 'gold': "🪙 طلا و سکه", 'crypto': "📈 رمزارزها", 'bubble': "🫧 حباب"}
+async def show_alerts_menu(query):
+    alerts = get_alert_engine().list_for_user(query.from_user.id)
+    keyboard = []
+    for alert_id, (_, target, direction, threshold) in alerts:
+        sign = ">" if direction == 'above' else "<"
+        keyboard.append([InlineKeyboardButton(f"\u200f🗑 {describe_alert_target(target)} {sign} {format_alert_value(target, threshold)}", callback_data=f"alert_delete_{alert_id}")])
+    if len(alerts) < MAX_ALERTS_PER_USER: keyboard.append([InlineKeyboardButton("➕ افزودن هشدار", callback_data='alert_add')])
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت به تنظیمات", callback_data='settings_main')])
+    text = "<b>هشدارهای قیمت شما:</b>\nبرای حذف هر هشدار روی آن بزنید." if alerts else "هیچ هشدار فعالی ندارید."
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+async def show_alert_group_menu(query):
+    keyboard = [[InlineKeyboardButton(name, callback_data=f"alert_group_{group}")] for group, name in ALERT_PICK_GROUPS.items()]
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت به هشدارها", callback_data='alerts_menu')])
+    await query.edit_message_text("هشدار برای کدام بخش؟", reply_markup=InlineKeyboardMarkup(keyboard))
+async def show_alert_target_menu(query, group):
+    targets = [f"BUBBLE_{symbol}" for symbol in BUBBLE_ITEMS] if group == 'bubble' else list(FULL_SYMBOL_LIST.get(group, {}))
+    keyboard, row = [], []
+    for target in targets:
+        row.append(InlineKeyboardButton(f"\u200f{describe_alert_target(target)}", callback_data=f"alert_target_{target}"))
+        if len(row) == 2:
+            keyboard.append(row)
+            row = []
+    if row: keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='alert_add')])
+    await query.edit_message_text("نماد مورد نظر را انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
+async def ask_alert_threshold(query, target, context):
+    context.user_data['pending_alert_target'] = target
+    snapshot = await get_price_snapshot()
+    current = alert_values(snapshot['prices']).get(target) if snapshot else None
+    current_text = f"\nمقدار فعلی: <code>{format_alert_value(target, current)}</code>" if current is not None else ""
+    unit_text = "درصد حباب" if target.startswith("BUBBLE_") else "قیمت"
+    await query.edit_message_text(f"&#x200f;{describe_alert_target(target)}{current_text}\n\n{unit_text} آستانه را به صورت عدد بفرستید (مثلاً <code>3</code> یا <code>1,350,000</code>):", parse_mode=ParseMode.HTML)
+async def alerts_callback_handler(query, callback_data, context):
+    if callback_data == 'alerts_menu': await show_alerts_menu(query)
+    elif callback_data == 'alert_add': await show_alert_group_menu(query)
+    elif callback_data.startswith('alert_group_'): await show_alert_target_menu(query, callback_data[len('alert_group_'):])
+    elif callback_data.startswith('alert_target_'): await ask_alert_threshold(query, callback_data[len('alert_target_'):], context)
+    elif callback_data.startswith('alert_delete_'):
+        engine, alert_id = get_alert_engine(), int(callback_data[len('alert_delete_'):])
+        if engine.remove(alert_id, query.from_user.id): await asyncio.to_thread(engine.delete_alerts, [alert_id])
+        await show_alerts_menu(query)
+def parse_number(text):
+    normalized = text.strip().translate(str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩٫", "01234567890123456789.")).replace(",", "").replace("٬", "").replace("%", "")
+    value = float(normalized)
+    # float() عبارت‌هایی مثل nan و inf و 1e999 را هم می‌پذیرد؛ چنین آستانه‌ای هرگز فعال نمی‌شود یا نمایه را به‌هم می‌ریزد
+    if not math.isfinite(value): raise ValueError(f"non-finite number: {text!r}")
+    return value
+async def receive_alert_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    target = context.user_data.pop('pending_alert_target')
+    try:
+        threshold = parse_number(update.message.text)
+    except ValueError:
+        await update.message.reply_text("❌ مقدار وارد شده عدد نیست. دوباره از منوی «تنظیمات» هشدار را اضافه کنید.")
+        return
+    engine = get_alert_engine()
+    if len(engine.list_for_user(update.effective_user.id)) >= MAX_ALERTS_PER_USER:
+        await update.message.reply_text(f"❌ حداکثر {MAX_ALERTS_PER_USER} هشدار فعال مجاز است.")
+        return
+    snapshot = await get_price_snapshot()
+    current = alert_values(snapshot['prices']).get(target) if snapshot else None
+    # جهت هشدار نسبت به مقدار فعلی تعیین می‌شود: آستانه بالاتر یعنی «عبور به بالا»
+    direction = 'above' if current is None or threshold >= current else 'below'
+    alert_id = await asyncio.to_thread(engine.insert, update.effective_user.id, target, direction, threshold)
+    engine.index_alert(alert_id, update.effective_user.id, target, direction, threshold)
+    sign = ">" if direction == 'above' else "<"
+    await update.message.reply_text(f"✅ هشدار ثبت شد: &#x200f;{describe_alert_target(target)} {sign} <code>{format_alert_value(target, threshold)}</code>", parse_mode=ParseMode.HTML)
+
+# --- تیکر زنده: یک پیام برای هر چت که با هر اسنپ‌شات تازه در جای خود ویرایش می‌شود ---
+# فقط یک نظرسنج پس‌زمینه قیمت‌ها را می‌گیرد؛ هر چت تنها وقتی ویرایش می‌شود که قیمت نمادهای انتخابی‌اش تغییر کرده باشد.
+# ویرایش‌ها برای هر چت ادغام می‌شوند: در هر لحظه حداکثر یک ویرایش در جریان است و فقط آخرین متن منتظر نگه داشته می‌شود.
+class TickerState:
+    __slots__ = ('chat_id', 'message_id', 'category', 'last_key', 'pending', 'flushing', 'last_edit_at')
+    def __init__(self, chat_id, message_id, category, last_key=None):
+        self.chat_id, self.message_id, self.category, self.last_key = chat_id, message_id, category, last_key
+        # فاصله ویرایش‌های تیکر همین‌جا نگه داشته می‌شود، نه در نوبت مشترک چت، تا پاسخ‌ها و هشدارهای همان چت معطل نشوند
+        self.pending, self.flushing, self.last_edit_at = None, False, time.monotonic()
+_tickers = {}
+# ظرفیت ۱: ویرایش‌های پس‌زمینه انفجاری نیستند و یکنواخت پخش می‌شوند تا سهم پیام‌های کاربران از سقف سراسری محفوظ بماند
+_ticker_edit_bucket = TokenBucket(TICKER_EDIT_RATE)
+_ticker_published_version = None
+TICKER_STOP_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("⏹ توقف نمایش زنده", callback_data='ticker_stop')]])
+async def load_tickers():
+    rows = await asyncio.to_thread(lambda: get_settings_store().conn.execute("SELECT chat_id, message_id, category FROM tickers").fetchall())
+    for chat_id, message_id, category in rows:
+        if owns_chat(chat_id): _tickers[chat_id] = TickerState(chat_id, message_id, category)
+    if _tickers: print(f"Resumed {len(_tickers)} live tickers.")
+def build_ticker_message(category, user_prefs, snapshot):
+    # خروجی: (کلید تغییر، متن)؛ کلید فقط به قیمت نمادهای انتخابی وابسته است و نه به ساعت
+    prices = snapshot['prices']
+    symbols = tuple(user_prefs.get(category, []))
+    key = tuple(prices[symbol].get('price') if symbol in prices else None for symbol in symbols)
+    updated_at = datetime.fromtimestamp(snapshot['fetched_at'], pytz.timezone('Asia/Tehran')).strftime('%H:%M:%S')
+    text = f"🔴 <b>نمایش زنده</b> — به‌روزرسانی {updated_at}\n{render_report(category, user_prefs, snapshot)}"
+    return (symbols, key), text
+async def start_ticker(bot, chat_id, category):
+    chat_id = str(chat_id)
+    snapshot = await get_price_snapshot()
+    if not snapshot: return False
+    key, text = build_ticker_message(category, get_user_prefs(chat_id), snapshot)
+    message = await send_rate_limited(bot, chat_id, kind="ticker", text=text, parse_mode=ParseMode.HTML, reply_markup=TICKER_STOP_MARKUP)
+    previous = _tickers.get(chat_id)
+    if previous: previous.pending = None
+    _tickers[chat_id] = TickerState(chat_id, message.message_id, category, key)
+    await asyncio.to_thread(get_settings_store().write, "INSERT OR REPLACE INTO tickers (chat_id, message_id, category) VALUES (?, ?, ?)", (chat_id, message.message_id, category))
+    return True
+async def stop_ticker(chat_id, message_id=None):
+    # تیکر یک گروه ممکن است در کارگر کاربر دیگری اجرا شود؛ حذف ردیف کافی است و آن کارگر در نظرسنجی بعدی متوقفش می‌کند.
+    # حالت درون‌حافظه پیش از اولین await کنار گذاشته می‌شود تا ویرایشی که در همین فاصله برسد دیگر ارسال نشود
+    chat_id = str(chat_id)
+    state = _tickers.get(chat_id)
+    if state is not None and message_id in (None, state.message_id):
+        del _tickers[chat_id]
+        state.pending = None
+    else: state = None
+    store = get_settings_store()
+    if message_id is None: deleted = await asyncio.to_thread(store.write, "DELETE FROM tickers WHERE chat_id = ?", (chat_id,))
+    else: deleted = await asyncio.to_thread(store.write, "DELETE FROM tickers WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+    return state is not None or deleted > 0
+def publish_ticker_snapshot(bot, snapshot):
+    # متن هر ترکیب (دسته، نمادها) یک بار ساخته می‌شود و بین همه چت‌های هم‌سلیقه مشترک است
+    global _ticker_published_version
+    _ticker_published_version = snapshot['version']
+    rendered, queued = {}, 0
+    for state in list(_tickers.values()):
+        user_prefs = get_user_prefs(state.chat_id)
+        group = (state.category, tuple(user_prefs.get(state.category, [])))
+        if group not in rendered: rendered[group] = build_ticker_message(state.category, user_prefs, snapshot)
+        key, text = rendered[group]
+        if key == state.last_key: continue
+        state.pending = (key, text)
+        queued += 1
+        if not state.flushing:
+            state.flushing = True
+            asyncio.create_task(_flush_ticker(bot, state))
+    return queued
+async def _flush_ticker(bot, state):
+    try:
+        while state.pending is not None and _tickers.get(state.chat_id) is state:
+            spacing = state.last_edit_at + TICKER_MIN_EDIT_INTERVAL - time.monotonic()
+            if spacing > 0: await asyncio.sleep(spacing)
+            delay = _ticker_edit_bucket.reserve(time.monotonic())
+            if delay: await asyncio.sleep(delay)
+            await telegram_rate_limiter.acquire(state.chat_id)
+            # متن پس از انتظار خوانده می‌شود تا اسنپ‌شات‌های رسیده در این فاصله در یک ویرایش ادغام شوند
+            if state.pending is None or _tickers.get(state.chat_id) is not state: break
+            key, text = state.pending
+            state.pending = None
+            try:
+                await safe_edit_message(bot.edit_message_text, text, chat_id=state.chat_id, message_id=state.message_id, parse_mode=ParseMode.HTML, reply_markup=TICKER_STOP_MARKUP)
+            except RetryAfter as e:
+                TELEGRAM_SEND_FAILURES.inc(type(e).__name__)
+                if state.pending is None: state.pending = (key, text)
+                await asyncio.sleep(e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after)
+                continue
+            except (BadRequest, Forbidden) as e:
+                # پیام حذف شده، متن رد شده یا کاربر ربات را مسدود کرده است؛ تیکر دیگر قابل ویرایش نیست
+                TELEGRAM_SEND_FAILURES.inc(type(e).__name__)
+                print(f"Stopping live ticker for {state.chat_id} (message {state.message_id}) after {type(e).__name__}: {e}")
+                await stop_ticker(state.chat_id, state.message_id)
+                break
+            except Exception as e:
+                TELEGRAM_SEND_FAILURES.inc(type(e).__name__)
+                print(f"Failed to update live ticker for {state.chat_id}: {e}")
+                state.last_edit_at = time.monotonic()
+                continue
+            # فاصله از پایان ویرایش قبلی حساب می‌شود تا صف شدن درخواست‌ها در استخر اتصال دو ویرایش را به هم نچسباند
+            state.last_edit_at = time.monotonic()
+            state.last_key = key
+            MESSAGES_SENT.inc("ticker_edit")
+    finally:
+        state.flushing = False
+async def ticker_poll_job(context: ContextTypes.DEFAULT_TYPE):
+    if not _tickers: return
+    if WORKER_COUNT > 1:
+        # تیکری که کارگر دیگری متوقف یا جایگزین کرده (مثلاً کاربر دیگری در همان گروه) اینجا هم کنار گذاشته می‌شود
+        rows = dict(await asyncio.to_thread(lambda: get_settings_store().conn.execute("SELECT chat_id, message_id FROM tickers").fetchall()))
+        for chat_id, state in list(_tickers.items()):
+            if rows.get(chat_id) != state.message_id:
+                del _tickers[chat_id]
+                state.pending = None
+    snapshot = _price_snapshot
+    if snapshot is None or time.time() - snapshot['fetched_at'] >= TICKER_POLL_INTERVAL:
+        # اسنپ‌شاتی که کارگر دیگری در همین بازه گرفته پذیرفته می‌شود تا هر کارگر جداگانه دریافت نکند
+        snapshot = await asyncio.shield(_start_price_refresh(TICKER_POLL_INTERVAL))
+    if snapshot and snapshot['version'] != _ticker_published_version: publish_ticker_snapshot(context.bot, snapshot)
+async def ticker_callback_handler(query, callback_data, context):
+    if callback_data == 'ticker_stop':
+        await stop_ticker(query.message.chat_id, query.message.message_id)
+        await safe_edit_message(query.edit_message_reply_markup, reply_markup=None)
+    elif callback_data.startswith('ticker_start_'):
+        category = callback_data[len('ticker_start_'):]
+        if category in FULL_SYMBOL_LIST and not await start_ticker(context.bot, query.message.chat_id, category):
+            await context.bot.send_message(query.message.chat_id, "❌ <b>خطای دریافت قیمت لحظه‌ای</b>. سرور API پاسخگو نیست.", parse_mode=ParseMode.HTML)
+@instrument_handler
+async def ticker_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /ticker [currency|gold|crypto] یک پیام زنده می‌سازد و /ticker stop آن را متوقف می‌کند
+    arg = context.args[0].lower() if context.args else 'currency'
+    if arg == 'stop':
+        stopped = await stop_ticker(update.effective_chat.id)
+        await update.message.reply_text("⏹ نمایش زنده متوقف شد." if stopped else "نمایش زنده فعالی ندارید.")
+        return
+    if arg not in FULL_SYMBOL_LIST:
+        await update.message.reply_text(f"دسته نامعتبر است. یکی از این‌ها را بنویسید: {', '.join(FULL_SYMBOL_LIST)}")
+        return
+    if not await start_ticker(context.bot, update.effective_chat.id, arg):
+        await update.message.reply_text("❌ <b>خطای دریافت قیمت لحظه‌ای</b>. سرور API پاسخگو نیست.", parse_mode=ParseMode.HTML)
+
+# --- نمودارها: رسم در استخر پردازه جدا تا حلقه رویداد مسدود نشود، و کش LRU تصویرها همراه با file_id تلگرام ---
+# تابع‌های render_* در پردازه‌های استخر اجرا می‌شوند و تاریخچه را مستقیم از فایل‌های نگاشت‌شده می‌خوانند.
+_chart_history = None
+def _init_chart_worker(history_dir):
+    global _chart_history
+    _chart_history = PriceHistory(history_dir)
+def _downsample(timestamps, values, limit=CHART_MAX_POINTS):
+    if len(timestamps) <= limit: return timestamps, values
+    index = np.linspace(0, len(timestamps) - 1, limit).astype(int)
+    return timestamps[index], values[index]
+def render_chart_png(title, series, ylabel):
+    # series: [(برچسب، زمان‌ها، مقادیر)]؛ خروجی بایت‌های PNG یا None اگر داده‌ای نباشد
+    if not series: return None
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import matplotlib.dates as mdates
+    tehran = pytz.timezone("Asia/Tehran")
+    figure = Figure(figsize=(8, 4.5), dpi=100)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    for label, timestamps, values in series: axes.plot(np.asarray(timestamps) / 86400.0, values, label=label, linewidth=1.4)
+    locator = mdates.AutoDateLocator(tz=tehran)
+    axes.xaxis.set_major_locator(locator)
+    axes.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator, tz=tehran))
+    axes.set_title(title)
+    axes.set_ylabel(ylabel)
+    axes.grid(alpha=0.3)
+    if len(series) > 1: axes.legend(loc='best')
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+def render_price_chart(symbols, start, end, range_label):
+    _chart_history.invalidate()
+    series = []
+    for symbol in symbols:
+        timestamps, prices = _chart_history.range(symbol, start, end)
+        if len(timestamps): series.append((symbol, *_downsample(timestamps, prices)))
+    # چند نماد با مقیاس‌های متفاوت به صورت درصد تغییر نسبت به ابتدای بازه رسم می‌شوند
+    if len(series) > 1: series = [(label, timestamps, (prices / prices[0] - 1) * 100) for label, timestamps, prices in series]
+    return render_chart_png(f"{' / '.join(symbols)} - {range_label}", series, "change %" if len(series) > 1 else "price")
+def render_bubble_chart(start, end, range_label):
+    _chart_history.invalidate()
+    series = []
+    for symbol, data in BubbleAnalytics(_chart_history, start, end).series.items():
+        timestamps, values = data.t[:data.count], data.v[:data.count]
+        keep = timestamps >= start
+        if keep.any(): series.append((symbol, *_downsample(timestamps[keep], values[keep])))
+    return render_chart_png(f"Bubble % - {range_label}", series, "bubble %")
+class ChartCache:
+    # کلید: (نمادهای مرتب، بازه، شماره بازه زمانی آخرین نقطه)؛ مقدار: {'png', 'file_id', 'upload'}
+    def __init__(self, max_entries):
+        self.max_entries, self.entries = max_entries, collections.OrderedDict()
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None: self.entries.move_to_end(key)
+        return entry
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+_chart_pool, _chart_cache, _chart_renders = None, ChartCache(CHART_CACHE_MAX_ENTRIES), {}
+def get_chart_pool():
+    global _chart_pool
+    if _chart_pool is None:
+        _chart_pool = concurrent.futures.ProcessPoolExecutor(CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                                             initializer=_init_chart_worker, initargs=(HISTORY_DIR,))
+    return _chart_pool
+def shutdown_chart_pool():
+    global _chart_pool
+    if _chart_pool is not None: _chart_pool.shutdown(wait=False, cancel_futures=True)
+    _chart_pool = None
+def chart_cache_key(symbols, range_label):
+    # تصویر به آخرین نقطه تاریخچه گردشده به وضوح نمودار (طول بازه / CHART_MAX_POINTS) وابسته است، نه به نسخه اسنپ‌شات؛
+    # پس نمودار ۳۰ روزه حدود هر ۴۳ دقیقه یک بار دوباره رسم می‌شود. خروجی None یعنی تاریخچه‌ای نیست
+    history = get_price_history()
+    latest = max((history.last_timestamp(symbol) or 0 for symbol in (BUBBLE_ITEMS if symbols == ('BUBBLE',) else symbols)), default=0)
+    if not latest: return None
+    return symbols, range_label, int(latest // (CHART_RANGES[range_label] / CHART_MAX_POINTS))
+async def _render_chart_entry(key):
+    symbols, range_label, bucket = key
+    # بازه از انتهای همان بازه زمانی حساب می‌شود تا تصویر فقط به کلید وابسته باشد
+    end = (bucket + 1) * CHART_RANGES[range_label] / CHART_MAX_POINTS
+    start, loop, started, pool = end - CHART_RANGES[range_label], asyncio.get_running_loop(), time.perf_counter(), get_chart_pool()
+    try:
+        if symbols == ('BUBBLE',):
+            png = await loop.run_in_executor(pool, render_bubble_chart, start, end, range_label)
+        else:
+            png = await loop.run_in_executor(pool, render_price_chart, symbols, start, end, range_label)
+    except concurrent.futures.process.BrokenProcessPool:
+        # یکی از پردازه‌های رسم مرده (مثلاً کمبود حافظه) و استخر دیگر کاری نمی‌پذیرد؛ کنار گذاشته می‌شود تا درخواست بعدی استخر تازه بسازد
+        if _chart_pool is pool: shutdown_chart_pool()
+        raise
+    CHART_RENDER_LATENCY.observe(time.perf_counter() - started)
+    entry = {'png': png, 'file_id': None, 'upload': None}
+    _chart_cache.put(key, entry)
+    return entry
+async def get_chart(key):
+    # درخواست‌های هم‌زمان برای یک کلید منتظر یک رسم مشترک می‌مانند
+    entry = _chart_cache.get(key)
+    if entry is not None:
+        CACHE_REQUESTS.inc('chart', 'hit')
+        return entry
+    task = _chart_renders.get(key)
+    if task is None:
+        CACHE_REQUESTS.inc('chart', 'miss')
+        task = _chart_renders[key] = asyncio.ensure_future(_render_chart_entry(key))
+        task.add_done_callback(lambda _: _chart_renders.pop(key, None))
+    else:
+        CACHE_REQUESTS.inc('chart', 'shared')
+    return await asyncio.shield(task)
+async def send_chart(bot, chat_id, symbols, range_label):
+    # خروجی False یعنی داده‌ای برای رسم نیست؛ فقط اولین ارسال هر تصویر آپلود می‌شود و بقیه با file_id ارسال می‌شوند.
+    # اگر استخر رسم از کار افتاده باشد BrokenProcessPool به فراخواننده می‌رسد
+    key = chart_cache_key(symbols, range_label)
+    if key is None: return False
+    entry = await get_chart(key)
+    if entry['png'] is None: return False
+    caption = f"📈 {' / '.join(symbols)} — {range_label}"
+    if entry['file_id'] is None and entry['upload'] is not None: await asyncio.shield(entry['upload'])
+    if entry['file_id'] is not None:
+        CACHE_REQUESTS.inc('chart_file_id', 'hit')
+        await send_rate_limited(bot, chat_id, kind="chart", method="send_photo", photo=entry['file_id'], caption=caption)
+        return True
+    CACHE_REQUESTS.inc('chart_file_id', 'miss')
+    upload = entry['upload'] = asyncio.get_running_loop().create_future()
+    try:
+        message = await send_rate_limited(bot, chat_id, kind="chart", method="send_photo", photo=entry['png'], caption=caption)
+        entry['file_id'] = message.photo[-1].file_id
+    finally:
+        # اگر آپلود شکست بخورد منتظرها خودشان دوباره آپلود می‌کنند
+        if entry['file_id'] is None: entry['upload'] = None
+        upload.set_result(None)
+    return True
+CHART_FAILED_MESSAGE = "❌ رسم نمودار با خطا مواجه شد. چند لحظه دیگر دوباره امتحان کنید."
+CHART_SYMBOLS = {symbol for symbols in FULL_SYMBOL_LIST.values() for symbol in symbols} | {'BUBBLE'}
+def parse_chart_request(args):
+    # خروجی: (نمادهای مرتب، بازه) یا None اگر ورودی نامعتبر باشد
+    range_label, symbols = '7d', set()
+    for arg in args:
+        if arg.lower() in CHART_RANGES: range_label = arg.lower()
+        elif arg.upper() in CHART_SYMBOLS: symbols.add(arg.upper())
+        else: return None
+    if not symbols or len(symbols) > CHART_MAX_SYMBOLS or ('BUBBLE' in symbols and len(symbols) > 1): return None
+    return tuple(sorted(symbols)), range_label
+@instrument_handler
+async def chart_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    request = parse_chart_request(context.args or [])
+    if request is None:
+        await update.message.reply_text(f"استفاده: /chart USD [EUR ...] [{'|'.join(CHART_RANGES)}]\nحداکثر {CHART_MAX_SYMBOLS} نماد؛ برای نمودار حباب: /chart BUBBLE 30d")
+        return
+    try:
+        if not await send_chart(context.bot, update.effective_chat.id, *request):
+            await update.message.reply_text("داده کافی برای رسم این نمودار ثبت نشده است.")
+    except concurrent.futures.process.BrokenProcessPool:
+        await update.message.reply_text(CHART_FAILED_MESSAGE)
+async def chart_callback_handler(query, callback_data, context):
+    request = parse_chart_request(callback_data.split(':')[1:])
+    if not request: return
+    try:
+        if not await send_chart(context.bot, query.message.chat_id, *request):
+            await context.bot.send_message(query.message.chat_id, "داده کافی برای رسم این نمودار ثبت نشده است.")
+    except concurrent.futures.process.BrokenProcessPool:
+        await context.bot.send_message(query.message.chat_id, CHART_FAILED_MESSAGE)
+
+# --- آمار عملیاتی: گیج‌ها، دستور /stats و راه‌اندازی/خاموشی ---
+_register(Gauge("hobab_price_snapshot_age_seconds", "Age of the cached price snapshot.", lambda: round(time.time() - _price_snapshot['fetched_at'], 3) if _price_snapshot else None))
+_register(Gauge("hobab_price_snapshot_version", "Version of the cached price snapshot.", lambda: _price_snapshot['version'] if _price_snapshot else None))
+_register(Gauge("hobab_price_providers_circuit_open", "Price providers whose circuit breaker rejects calls.", lambda: sum(provider.breaker.state == "open" for provider in get_price_providers())))
+_register(Gauge("hobab_scheduled_subscriptions", "Chat/slot pairs in the schedule index.", lambda: sum(len(chats) for chats in _schedule_index.values()) if _schedule_index is not None else None))
+_register(Gauge("hobab_active_alerts", "Active price alerts.", lambda: len(_alert_engine.alerts) if _alert_engine is not None else None))
+_register(Gauge("hobab_live_tickers", "Chats with an active live ticker message.", lambda: len(_tickers)))
+_register(Gauge("hobab_ticker_pending_edits", "Live tickers waiting for an edit slot.", lambda: sum(1 for state in _tickers.values() if state.pending is not None)))
+def _format_ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+def _hit_ratio(cache):
+    hits = sum(value for (name, result), value in CACHE_REQUESTS.values.items() if name == cache and result != 'miss')
+    total = sum(value for (name, _), value in CACHE_REQUESTS.values.items() if name == cache)
+    return f"{hits * 100 / total:.1f}% از {total:,}" if total else "-"
+def build_stats_report():
+    lines = ["📊 <b>آمار ربات</b>\n", "⏱ <b>هندلرها</b> (تعداد، p50، p95):"]
+    for (handler,), (_, _, count) in sorted(HANDLER_LATENCY.values.items()):
+        lines.append(f"<code>{handler}</code>: {count:,} | {_format_ms(HANDLER_LATENCY.quantile(0.5, handler))} | {_format_ms(HANDLER_LATENCY.quantile(0.95, handler))}")
+    lines += ["", "🌐 <b>منابع قیمت:</b>"]
+    for provider in get_price_providers():
+        fetches = sum(state[2] for (name, _), state in UPSTREAM_FETCH_LATENCY.values.items() if name == provider.name)
+        errors = ", ".join(f"{error}: {count}" for (name, error), count in sorted(UPSTREAM_FETCH_ERRORS.values.items()) if name == provider.name) or "-"
+        hedges = HEDGED_REQUESTS.values.get((provider.name, 'sent'), 0)
+        lines.append(f"<code>{provider.name}</code>: {fetches:,} تلاش، p95 {_format_ms(UPSTREAM_FETCH_LATENCY.quantile(0.95, provider.name, 'success'))}، "
+                     f"hedge {hedges:,}، پرت {PRICE_OUTLIERS.values.get((provider.name,), 0):,}، مدار {provider.breaker.state}، خطاها: {errors}")
+    lines += ["", "🗃 <b>نرخ برخورد کش:</b>"] + [f"{cache}: {_hit_ratio(cache)}" for cache in ('price_snapshot', 'report_fragment', 'settings', 'chart', 'chart_file_id')]
+    lines += ["", f"💾 <b>تنظیمات:</b> به‌روزرسانی p95 {_format_ms(SETTINGS_IO_LATENCY.quantile(0.95, 'update'))}، خواندن p95 {_format_ms(SETTINGS_IO_LATENCY.quantile(0.95, 'read'))}"]
+    lines += [f"⏰ <b>تأخیر زمان‌بند:</b> p50 {_format_ms(SCHEDULER_LAG.quantile(0.5))}، p95 {_format_ms(SCHEDULER_LAG.quantile(0.95))}"]
+    sent = ", ".join(f"{kind}: {count:,}" for (kind,), count in sorted(MESSAGES_SENT.values.items())) or "-"
+    failures = ", ".join(f"{error}: {count}" for (error,), count in sorted(TELEGRAM_SEND_FAILURES.values.items())) or "-"
+    lines += [f"📤 <b>ارسال‌ها:</b> {sent}", f"❌ <b>خطاهای ارسال:</b> {failures}"]
+    return "\n".join(lines)
+@instrument_handler
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS: return
+    await update.message.reply_text(build_stats_report(), parse_mode=ParseMode.HTML)
+_metrics_server = None
+async def on_startup(application):
+    global _metrics_server
+    await start_alert_dispatcher(application)
+    await load_tickers()
+    # ساخت تحلیل حباب از کل تاریخچه سنگین است؛ پیش از اولین درخواست و بیرون از حلقه رویداد انجام می‌شود
+    await asyncio.to_thread(get_bubble_analytics)
+    _metrics_server = await start_metrics_server()
+async def on_shutdown(application):
+    if _metrics_server is not None: _metrics_server.close()
+    shutdown_chart_pool()
+    await close_http_client(application)
+
+# --- حالت وب‌هوک: مسیریاب محلی که هر به‌روزرسانی را بر اساس شناسه فرستنده به یک پردازه کارگر می‌فرستد ---
+# همه به‌روزرسانی‌های یک کاربر (حتی از گروه‌ها) به یک کارگر می‌رسند، چون تنظیمات، زمان‌بندی، هشدارها و user_data بر اساس
+# شناسه کاربر نگه داشته می‌شوند؛ فقط به‌روزرسانی‌های بدون فرستنده (پست کانال) بر اساس شناسه چت پخش می‌شوند.
+def update_shard_id(payload):
+    for key, value in payload.items():
+        if key == 'update_id' or not isinstance(value, dict): continue
+        user = value.get('from') or value.get('user')
+        if user: return user['id']
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat: return chat['id']
+    return payload.get('update_id', 0)
+class WebhookRouter:
+    def __init__(self, path, secret, worker_ports):
+        self.path, self.secret, self.worker_ports = path, secret, worker_ports
+        self.idle = [[] for _ in worker_ports]
+    async def _read_message(self, reader):
+        # خروجی: (خط اول، سرآیندها، بدنه) یا None اگر اتصال بسته شده باشد
+        first_line = await reader.readline()
+        if not first_line: return None
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return first_line.decode('latin-1').rstrip(), headers, body
+    async def _forward_once(self, index, body, reuse):
+        connection = self.idle[index].pop() if reuse and self.idle[index] else await asyncio.open_connection('127.0.0.1', self.worker_ports[index])
+        reader, writer = connection
+        try:
+            writer.write(f"POST {self.path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                         f"X-Telegram-Bot-Api-Secret-Token: {self.secret}\r\nContent-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+            await writer.drain()
+            response = await self._read_message(reader)
+            if response is None: raise ConnectionResetError("worker closed the connection")
+        except BaseException:
+            writer.close()
+            raise
+        self.idle[index].append(connection)
+        return int(response[0].split(' ', 2)[1])
+    async def forward(self, index, body):
+        # اتصال keep-alive ممکن است از سمت کارگر بسته شده باشد؛ در این حالت یک بار با اتصال تازه تلاش می‌شود
+        try: return await self._forward_once(index, body, reuse=True)
+        except (ConnectionError, asyncio.IncompleteReadError): return await self._forward_once(index, body, reuse=False)
+    async def handle_connection(self, reader, writer):
+        try:
+            while (request := await self._read_message(reader)) is not None:
+                request_line, headers, body = request
+                method, target = request_line.split(' ', 2)[:2]
+                if method != 'POST' or target.split('?', 1)[0] != self.path: status = 404
+                elif headers.get('x-telegram-bot-api-secret-token') != self.secret: status = 403
+                else:
+                    try:
+                        status = await self.forward(int(update_shard_id(json.loads(body))) % len(self.worker_ports), body)
+                    except ValueError: status = 400
+                    except (OSError, asyncio.IncompleteReadError) as e:
+                        print(f"Webhook worker unavailable: {e}")
+                        status = 502
+                writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Length: 0\r\n\r\n".encode('latin-1'))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+def run_worker(index, count, secret):
+    global WORKER_INDEX, WORKER_COUNT, METRICS_PORT
+    WORKER_INDEX, WORKER_COUNT = index, count
+    if METRICS_PORT: METRICS_PORT += index
+    application = build_application()
+    # همه کارگرها همان آدرس عمومی و secret را ثبت می‌کنند؛ setWebhook تکراری بی‌اثر است
+    application.run_webhook(listen="127.0.0.1", port=WEBHOOK_WORKER_BASE_PORT + index, url_path=urlsplit(WEBHOOK_URL).path,
+                           secret_token=secret, webhook_url=WEBHOOK_URL, allowed_updates=Update.ALL_TYPES)
+async def serve_webhook_cluster(secret):
+    # کارگرها در پردازه‌های جدا اجرا می‌شوند و اگر یکی از کار بیفتد دوباره راه‌اندازی می‌شود
+    context, workers = multiprocessing.get_context("spawn"), {}
+    def spawn(index):
+        workers[index] = context.Process(target=run_worker, args=(index, WEBHOOK_WORKERS, secret), name=f"hobab-worker-{index}")
+        workers[index].start()
+    for index in range(WEBHOOK_WORKERS): spawn(index)
+    router = WebhookRouter(urlsplit(WEBHOOK_URL).path or "/", secret, [WEBHOOK_WORKER_BASE_PORT + index for index in range(WEBHOOK_WORKERS)])
+    server = await asyncio.start_server(router.handle_connection, WEBHOOK_LISTEN, WEBHOOK_PORT)
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    print(f"✅ مسیریاب وب‌هوک روی {WEBHOOK_LISTEN}:{WEBHOOK_PORT} با {WEBHOOK_WORKERS} کارگر اجرا شد...")
+    try:
+        while not stop.is_set():
+            try: await asyncio.wait_for(stop.wait(), timeout=1)
+            except asyncio.TimeoutError: pass
+            for index, process in list(workers.items()):
+                if not process.is_alive() and not stop.is_set():
+                    print(f"Webhook worker {index} exited with code {process.exitcode}; restarting.")
+                    spawn(index)
+    finally:
+        server.close()
+        for process in workers.values(): process.terminate()
+        for process in workers.values(): await asyncio.to_thread(process.join, 30)
+def run_webhook_cluster():
+    # مهاجرت یک‌باره تنظیمات و تاریخچه قدیمی پیش از راه‌اندازی کارگرها انجام می‌شود تا پردازه‌ها با هم رقابت نکنند
+    get_settings_store()
+    _cluster_conn()
+    get_price_history()
+    asyncio.run(serve_webhook_cluster(WEBHOOK_SECRET or secrets.token_urlsafe(32)))
+
+async def price_watch_job(context: ContextTypes.DEFAULT_TYPE):
+    # تا وقتی هشدار فعالی هست اسنپ‌شات حداکثر هر PRICE_CACHE_TTL تازه می‌شود تا هشدارها بدون انتظار برای درخواست کاربر
+    # یا کار ساعتی بررسی شوند؛ در حالت چندپردازه اسنپ‌شات تازه کارگر دیگر پذیرفته می‌شود
+    if _alert_engine is None or not _alert_engine.alerts: return
+    if _price_snapshot is None or time.time() - _price_snapshot['fetched_at'] >= PRICE_CACHE_TTL / 2: await _start_price_refresh()
+def build_application():
+    builder = Application.builder().token(TELEGRAM_TOKEN).post_init(on_startup).post_shutdown(on_shutdown)
+    if TELEGRAM_API_BASE_URL: builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    application = builder.build()
     job_queue = application.job_queue
     job_queue.run_repeating(update_hourly_data, interval=3600, first=5)
     job_queue.run_repeating(auto_message_scheduler, interval=60)
+    job_queue.run_repeating(price_watch_job, interval=PRICE_CACHE_TTL, first=PRICE_CACHE_TTL)
+    job_queue.run_repeating(ticker_poll_job, interval=TICKER_POLL_INTERVAL, first=TICKER_POLL_INTERVAL)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("bubble_history", bubble_history_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("ticker", ticker_command))
+    application.add_handler(CommandHandler("chart", chart_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, main_menu_handler))
     application.add_handler(CallbackQueryHandler(settings_callback_handler))
+    return application
+
+def main() -> None:
+    if WEBHOOK_URL:
+        run_webhook_cluster()
+        return
+    application = build_application()
     print("✅ ربات نهایی با زمان‌بندی چندگانه و معماری کامل اجرا شد...")
     application.run_polling()
 